@@ -0,0 +1,200 @@
+# encoding: utf-8
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+
+from libs import metrics
+from libs.ftp import FTPClient
+from libs.compress import Policy
+from libs.standin import StandInServer, VirtualFS
+
+
+MB = 1024 * 1024
+
+
+def _connect(address):
+    client = FTPClient(*address)
+    client.connect()
+    client.login('bench', 'bench')
+    return client
+
+
+def _stats(samples):
+    samples = sorted(samples)
+    return {'min': samples[0],
+            'median': samples[len(samples) // 2],
+            'p95': samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+            'max': samples[-1],
+            'runs': len(samples)}
+
+
+def bench_connect(address, runs):
+    samples = []
+    for _ in xrange(runs):
+        started = time.time()
+        client = _connect(address)
+        samples.append((time.time() - started) * 1000)
+        client.quit()
+    return {'name': 'connect_login', 'unit': 'ms', 'stats': _stats(samples)}
+
+
+def bench_download(address, tmp, size, runs, passive, compression='never'):
+    target = os.path.join(tmp, 'download.bin')
+    client = _connect(address)
+    client.compression = Policy(compression)
+    samples = []
+    for _ in xrange(runs):
+        started = time.time()
+        if not client.download('/big.bin', target, passive=passive):
+            raise RuntimeError('download failed')
+        samples.append(size / MB / (time.time() - started))
+    client.quit()
+
+    if os.path.getsize(target) != size:
+        raise RuntimeError('download is %d bytes, expected %d'
+                           % (os.path.getsize(target), size))
+    return {'name': 'download', 'unit': 'MB/s',
+            'params': {'size': size, 'passive': passive,
+                       'mode_z': compression == 'always'},
+            'stats': _stats(samples)}
+
+
+def bench_upload(address, tmp, size, runs):
+    source = os.path.join(tmp, 'upload.bin')
+    with open(source, 'wb') as f:
+        f.truncate(size)
+
+    client = _connect(address)
+    client.compression = Policy('never')
+    samples = []
+    for i in xrange(runs):
+        started = time.time()
+        if not client.upload('/up/upload%d.bin' % i, source):
+            raise RuntimeError('upload failed')
+        samples.append(size / MB / (time.time() - started))
+    client.quit()
+    return {'name': 'upload', 'unit': 'MB/s', 'params': {'size': size},
+            'stats': _stats(samples)}
+
+
+def bench_list(address, count, runs):
+    client = _connect(address)
+    samples = []
+    for _ in xrange(runs):
+        started = time.time()
+        success, entries = client.list('/list%d' % count, refresh=True)
+        samples.append((time.time() - started) * 1000)
+        if not success or len(entries) != count + 1:
+            raise RuntimeError('listing of %d entries failed' % count)
+    client.quit()
+    return {'name': 'list', 'unit': 'ms', 'params': {'entries': count},
+            'stats': _stats(samples)}
+
+
+def bench_small_files(address, tmp, count, size):
+    client = _connect(address)
+
+    started = time.time()
+    for i in xrange(count):
+        if not client.download('/small/file%07d' % i,
+                               os.path.join(tmp, 'small.bin')):
+            raise RuntimeError('download of small file %d failed' % i)
+    down = count / (time.time() - started)
+
+    started = time.time()
+    for i in xrange(count):
+        if not client.upload('/up/small%07d' % i,
+                             os.path.join(tmp, 'small.bin')):
+            raise RuntimeError('upload of small file %d failed' % i)
+    up = count / (time.time() - started)
+
+    client.quit()
+    return [{'name': 'small_files_download', 'unit': 'files/s',
+             'params': {'count': count, 'size': size},
+             'stats': _stats([down])},
+            {'name': 'small_files_upload', 'unit': 'files/s',
+             'params': {'count': count, 'size': size},
+             'stats': _stats([up])}]
+
+
+def run(args):
+    fs = VirtualFS()
+    fs.add_file('/big.bin', args.size * MB)
+    fs.add_dir('/up')
+    for count in args.listings:
+        fs.populate('/list%d' % count, count, size=1024)
+    fs.populate('/small', args.small_files, size=args.small_size)
+
+    server = StandInServer(fs).start()
+    tmp = tempfile.mkdtemp(prefix='ftpient-bench-')
+    address = server.address
+
+    results = []
+    try:
+        results.append(bench_connect(address, args.runs * 10))
+        results.append(bench_download(address, tmp, args.size * MB,
+                                      args.runs, passive=True))
+        results.append(bench_download(address, tmp, args.size * MB,
+                                      args.runs, passive=False))
+        results.append(bench_download(address, tmp, args.size * MB,
+                                      args.runs, passive=True,
+                                      compression='always'))
+        results.append(bench_upload(address, tmp, args.size * MB, args.runs))
+        for count in args.listings:
+            results.append(bench_list(address, count,
+                                      args.runs if count <= 100000 else 1))
+        results.extend(bench_small_files(address, tmp, args.small_files,
+                                         args.small_size))
+    finally:
+        server.stop()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    return {'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'results': results,
+            'metrics': metrics.registry.snapshot()}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='benchmark FTPClient against a local stand-in server')
+    parser.add_argument('-o', '--output', help='write results as json here')
+    parser.add_argument('--size', type=int, default=256,
+                        help='transfer size in MB (default 256)')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--listings', type=int, nargs='+',
+                        default=[1000, 10000, 100000, 1000000])
+    parser.add_argument('--small-files', type=int, default=500)
+    parser.add_argument('--small-size', type=int, default=4096)
+    parser.add_argument('--quick', action='store_true',
+                        help='32MB transfers and listings up to 100k entries')
+    args = parser.parse_args()
+
+    if args.quick:
+        args.size = 32
+        args.listings = [n for n in args.listings if n <= 100000]
+
+    # per-command logging would dominate the numbers being measured
+    logging.getLogger('libs').setLevel(logging.WARNING)
+
+    report = run(args)
+    for result in report['results']:
+        print '%-22s %-42s %10.2f %s' % (
+            result['name'], json.dumps(result.get('params', {}),
+                                       sort_keys=True),
+            result['stats']['median'], result['unit'])
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,400 @@
+# encoding: utf-8
+import os
+import sys
+import time
+import shlex
+import logging
+import socket
+import argparse
+import posixpath
+
+from libs import logs
+from libs.fxp import FXP
+from libs.ftp import FTPClient
+from libs.pool import SessionPool
+from libs.cache import ContentCache
+from libs.index import RemoteIndex, Crawler, index_path
+from libs.mirror import Mirror, modify_to_epoch
+from libs.progress import ProgressReporter
+from libs.segment import SegmentedDownload
+
+
+def _progress_printer(stream=sys.stderr):
+    def _(progress):
+        percent = 100.0 * progress.now / progress.total if progress.total \
+                  else 100.0
+        stream.write('\r%6.1f%% %10d/%d %8.1f KB/s' % (
+            percent, progress.now, progress.total, progress.rate / 1024))
+        if progress.now >= progress.total:
+            stream.write('\n')
+        stream.flush()
+    return _
+
+
+class Session(object):
+
+    def __init__(self, options):
+        self.options = options
+        self._m_pool = None
+        self._m_index = None
+
+
+    @property
+    def pool(self):
+        if self._m_pool is None:
+            content_cache = None
+            if self.options.cache_size:
+                content_cache = ContentCache(self.options.cache_dir,
+                                             self.options.cache_size * 2 ** 20)
+            self._m_pool = SessionPool(self.options.host, self.options.user,
+                                       self.options.password,
+                                       server_port=self.options.port,
+                                       size=self.options.workers,
+                                       content_cache=content_cache)
+        return self._m_pool
+
+
+    @property
+    def index(self):
+        if self._m_index is None:
+            self._m_index = RemoteIndex(
+                self.options.index or index_path(self.options.host,
+                                                 self.options.user,
+                                                 self.options.port))
+        return self._m_index
+
+
+    def _callback(self):
+        if self.options.quiet or not sys.stderr.isatty():
+            return lambda _1, _2: 1
+        return ProgressReporter(_progress_printer())
+
+
+    def ls(self, args):
+        with self.pool.session() as client:
+            if client is None:
+                return False
+            success, entries = client.list(args.path, refresh=True)
+        if not success:
+            return False
+
+        for i in xrange(len(entries)):
+            name = entries.name(i)
+            if name == u'..':
+                continue
+            if entries.is_file(i):
+                size = '%d' % entries.sizes[i]
+            else:
+                size = '-'
+            mtime = modify_to_epoch(int(entries.mtimes[i]))
+            if mtime:
+                mtime = time.strftime('%Y-%m-%d %H:%M', time.gmtime(mtime))
+            else:
+                mtime = ' ' * 16
+            print '%s %12s %s %s' % ('-' if entries.is_file(i) else 'd',
+                                     size, mtime, name.encode('utf-8'))
+        return True
+
+
+    def get(self, args):
+        if args.segments > 1 and (args.resume or args.verify):
+            print >> sys.stderr, 'get: --segments cannot be used with ' \
+                                 '--resume or --verify'
+            return False
+
+        local = args.local or posixpath.basename(args.remote)
+        if os.path.isdir(local):
+            local = os.path.join(local, posixpath.basename(args.remote))
+
+        callback = self._callback()
+        if args.segments > 1:
+            # the ranges take their sessions from the pool, none is held here
+            download = SegmentedDownload(None, args.segments, pool=self.pool)
+            return download.download(args.remote, local, callback=callback)
+
+        with self.pool.session() as client:
+            if client is None:
+                return False
+            return client.download(args.remote, local, callback=callback,
+                                   resume=args.resume, verify=args.verify)
+
+
+    def put(self, args):
+        remote = args.remote or os.path.basename(args.local)
+        if remote.endswith('/'):
+            remote += os.path.basename(args.local)
+
+        callback = self._callback()
+        with self.pool.session() as client:
+            if client is None:
+                return False
+            return client.upload(remote, args.local, callback=callback,
+                                 resume=args.resume, verify=args.verify)
+
+
+    def mirror(self, args):
+        mirror = Mirror(self.pool, workers=self.options.workers)
+        if args.upload:
+            ret = mirror.upload(args.local, args.remote)
+        else:
+            ret = mirror.download(args.remote, args.local)
+
+        print '%d transferred, %d skipped, %d failed, %d bytes in %.1fs' % (
+            ret['transferred'], ret['skipped'], len(ret['failed']),
+            ret['bytes'], ret['elapsed'])
+        for failed in ret['failed']:
+            print >> sys.stderr, 'failed: %s' % failed
+        return not ret['failed']
+
+
+    def fxp(self, args):
+        host, _, port = args.to.partition(':')
+        target = FTPClient(host, int(port or 21))
+        monitor = None
+        try:
+            target.connect()
+            if not target.login(args.to_user, args.to_password):
+                print >> sys.stderr, 'cannot log in to %s' % args.to
+                return False
+            if not self.options.quiet:
+                monitor = target.clone()
+
+            with self.pool.session() as source:
+                if source is None:
+                    return False
+                fxp = FXP(source, target, monitor=monitor)
+                if len(args.sources) == 1:
+                    return fxp.transfer(args.sources[0], args.target,
+                                        callback=self._callback())
+
+                directory = args.target.rstrip('/') + '/'
+                quiet = self.options.quiet or not sys.stderr.isatty()
+                ret = fxp.transfer_many(
+                    [(source_path, directory) for source_path in args.sources],
+                    callback=(lambda _: 1) if quiet else _progress_printer())
+        except socket.error as e:
+            print >> sys.stderr, '%s: %s' % (args.to, e)
+            return False
+        finally:
+            for client in (target, monitor):
+                if client is not None and client.connected:
+                    client.quit()
+
+        print '%d transferred, %d failed, %d bytes in %.1fs' % (
+            ret['transferred'], len(ret['failed']), ret['bytes'],
+            ret['elapsed'])
+        for failed in ret['failed']:
+            print >> sys.stderr, 'failed: %s' % failed
+        return not ret['failed']
+
+
+    def index_(self, args):
+        crawler = Crawler(self.pool, self.index, workers=self.options.workers)
+        ret = crawler.crawl(args.path, full=args.full)
+
+        print '%d listed, %d unchanged, %d entries in %.1fs' % (
+            ret['listed'], ret['checked'], ret['entries'], ret['elapsed'])
+        for failed in ret['failed']:
+            print >> sys.stderr, 'failed: %s' % failed
+        return not ret['failed']
+
+
+    def search(self, args):
+        text = args.text.decode('utf-8') if args.text else None
+        glob = text and any(c in text for c in u'*?[')
+        found = self.index.search(
+            pattern=text if glob else None,
+            substring=None if glob else text,
+            min_size=args.min_size, max_size=args.max_size,
+            after=args.after, before=args.before, under=args.under,
+            files_only=args.files, limit=args.limit)
+
+        for entry in found:
+            size = '%d' % entry.size if entry.is_file else '-'
+            print '%s %12s %s %s' % ('-' if entry.is_file else 'd', size,
+                                     entry.modify, entry.path.encode('utf-8'))
+        return True
+
+
+    def batch(self, args):
+        script = sys.stdin if args.script == '-' else open(args.script)
+        parser = command_parser(_ScriptParser)
+        success = True
+        try:
+            for number, line in enumerate(script, 1):
+                try:
+                    argv = shlex.split(line, comments=True)
+                    if not argv:
+                        continue
+                    command = parser.parse_args(argv)
+                except (_ScriptError, ValueError) as e:
+                    print >> sys.stderr, '%s:%d: %s' % (args.script, number,
+                                                         e)
+                    if not args.keep_going:
+                        return False
+                    success = False
+                    continue
+                if command.command == 'batch':
+                    print >> sys.stderr, '%s:%d: batch cannot nest' % (
+                        args.script, number)
+                    return False
+                if not self.run(command):
+                    print >> sys.stderr, '%s:%d: %s failed' % (
+                        args.script, number, line.strip())
+                    if not args.keep_going:
+                        return False
+                    success = False
+        finally:
+            if script is not sys.stdin:
+                script.close()
+        return success
+
+
+    def run(self, args):
+        # 'index' is taken by the property
+        if args.command == 'index':
+            return self.index_(args)
+        return getattr(self, args.command)(args)
+
+
+    def close(self):
+        if self._m_pool is not None:
+            self._m_pool.close()
+        if self._m_index is not None:
+            self._m_index.close()
+
+
+
+def _modify(text):
+    # a date as the modify fact it is compared with
+    digits = ''.join(c for c in text if c.isdigit())
+    if len(digits) not in (8, 12, 14):
+        raise argparse.ArgumentTypeError('expected YYYY-MM-DD[THH:MM[:SS]]')
+    return int(digits.ljust(14, '0'))
+
+
+class _ScriptError(Exception):
+    pass
+
+
+
+class _ScriptParser(argparse.ArgumentParser):
+
+    # a bad line of a script is reported, not a reason to exit
+    def error(self, message):
+        raise _ScriptError(message)
+
+
+    def exit(self, status=0, message=None):
+        raise _ScriptError(message or 'exited')
+
+
+
+def command_parser(parser_class=argparse.ArgumentParser):
+    parser = parser_class(prog='ftpient', add_help=False)
+    commands = parser.add_subparsers(dest='command')
+
+    ls = commands.add_parser('ls', help='list a remote directory')
+    ls.add_argument('path', nargs='?', default='')
+
+    for name, help in (('get', 'download a file'),
+                       ('put', 'upload a file')):
+        command = commands.add_parser(name, help=help)
+        if name == 'get':
+            command.add_argument('remote')
+            command.add_argument('local', nargs='?')
+            command.add_argument('--segments', type=int, default=1,
+                                 help='parallel ranges for big files')
+        else:
+            command.add_argument('local')
+            command.add_argument('remote', nargs='?')
+        command.add_argument('--resume', action='store_true',
+                             help='continue a partial transfer')
+        command.add_argument('--verify', action='store_true',
+                             help='compare checksums with the server')
+
+    mirror = commands.add_parser('mirror', help='synchronise a directory tree')
+    mirror.add_argument('remote')
+    mirror.add_argument('local')
+    mirror.add_argument('--upload', action='store_true',
+                        help='push local to remote instead')
+
+    fxp = commands.add_parser('fxp', help='copy to another server, the data '
+                                          'goes between the servers')
+    fxp.add_argument('sources', nargs='+', metavar='source')
+    fxp.add_argument('target', help='remote path on the other server, a '
+                                    'directory for several sources')
+    fxp.add_argument('--to', required=True, metavar='HOST[:PORT]')
+    fxp.add_argument('--to-user', default='anonymous')
+    fxp.add_argument('--to-password',
+                     default=os.environ.get('FTPIENT_TO_PASSWORD', ''))
+
+    index = commands.add_parser('index', help='crawl the remote tree into '
+                                              'the local index')
+    index.add_argument('path', nargs='?', default='/')
+    index.add_argument('--full', action='store_true',
+                       help='list every directory, changed or not')
+
+    search = commands.add_parser('search', help='find remote files in the '
+                                                'index, offline')
+    search.add_argument('text', nargs='?',
+                        help='part of a name, or a glob with * ? [')
+    search.add_argument('--min-size', type=int)
+    search.add_argument('--max-size', type=int)
+    search.add_argument('--after', type=_modify,
+                        help='modified at or after, YYYY-MM-DD[THH:MM:SS]')
+    search.add_argument('--before', type=_modify)
+    search.add_argument('--under', help='only below this remote directory')
+    search.add_argument('--files', action='store_true',
+                        help='leave out directories')
+    search.add_argument('--limit', type=int, default=1000)
+
+    batch = commands.add_parser('batch', help='run commands from a file')
+    batch.add_argument('script', help="one command per line, '-' for stdin")
+    batch.add_argument('--keep-going', action='store_true')
+
+    commands.add_parser('gui', help='open the graphical client')
+    return parser
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='ftpient', description='command line FTP client',
+        parents=[command_parser()])
+    parser.add_argument('-H', '--host', default='127.0.0.1')
+    parser.add_argument('-P', '--port', type=int, default=21)
+    parser.add_argument('-u', '--user', default='anonymous')
+    parser.add_argument('-p', '--password',
+                        default=os.environ.get('FTPIENT_PASSWORD', ''))
+    parser.add_argument('-w', '--workers', type=int, default=4)
+    parser.add_argument('--cache-size', type=int, default=0,
+                        help='MB of downloads kept to skip fetching unchanged '
+                             'files again, 0 turns the cache off')
+    parser.add_argument('--cache-dir',
+                        default=os.path.join(os.path.expanduser('~'),
+                                             '.ftpient', 'content'))
+    parser.add_argument('--index', help='index database, one per server '
+                                        'under ~/.ftpient by default')
+    parser.add_argument('-q', '--quiet', action='store_true')
+    parser.add_argument('-v', '--verbose', action='count', default=0)
+    options = parser.parse_args(argv)
+
+    if options.command == 'gui':
+        # Qt is only imported here
+        import ui
+        return ui.main()
+
+    logs.setup([logging.WARNING, logging.INFO, logging.DEBUG]
+               [min(options.verbose, 2)])
+
+    session = Session(options)
+    try:
+        success = session.run(options)
+    finally:
+        session.close()
+        logs.pipeline.stop()
+    return 0 if success else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1 +1,7 @@
 __author__ = 'wo'
+
+import logging
+
+# applications configure logging, see libs.logs; without them the library
+# stays quiet
+logging.getLogger(__name__).addHandler(logging.NullHandler())
@@ -0,0 +1,252 @@
+# encoding: utf-8
+import os
+import time
+import shutil
+import thread
+import hashlib
+import posixpath
+import threading
+from collections import OrderedDict
+
+
+class ListingCache(object):
+
+    def __init__(self, ttl=30, max_items=200000):
+        self._c_ttl = ttl
+        self._c_max_items = max_items
+
+        self._m_lock = threading.Lock()
+        self._m_listings = OrderedDict()
+        self._m_items = 0
+
+
+    @staticmethod
+    def normalize(path):
+        path = posixpath.normpath(path.replace('\\', '/'))
+        return '/' if path == '//' else path
+
+
+    def get(self, path):
+        key = self.normalize(path)
+        with self._m_lock:
+            cached = self._m_listings.pop(key, None)
+            if cached is None:
+                return None
+
+            stored, entries = cached
+            if time.time() - stored > self._c_ttl:
+                self._m_items -= len(entries)
+                return None
+
+            self._m_listings[key] = cached
+            return entries
+
+
+    def put(self, path, entries):
+        key = self.normalize(path)
+        with self._m_lock:
+            old = self._m_listings.pop(key, None)
+            if old is not None:
+                self._m_items -= len(old[1])
+
+            if len(entries) > self._c_max_items:
+                return
+            self._m_listings[key] = time.time(), entries
+            self._m_items += len(entries)
+
+            while self._m_items > self._c_max_items:
+                _, (_, evicted) = self._m_listings.popitem(last=False)
+                self._m_items -= len(evicted)
+
+
+    def invalidate(self, path=None):
+        with self._m_lock:
+            if path is None:
+                self._m_listings.clear()
+                self._m_items = 0
+                return
+
+            old = self._m_listings.pop(self.normalize(path), None)
+            if old is not None:
+                self._m_items -= len(old[1])
+
+
+
+class ContentCache(object):
+
+    def __init__(self, directory, capacity=2 * 1024 ** 3, link=True):
+        self.directory = directory
+        self._c_capacity = capacity
+        # targets served from the cache may be hardlinks to the cached copy,
+        # so a download into an existing target first detaches it, and a
+        # cached copy changed through such a link is never served again
+        self._c_link = link and hasattr(os, 'link')
+
+        self._m_lock = threading.Lock()
+        # key: (size, mtime) of the cached copy as it was stored
+        self._m_files = OrderedDict()
+        self._m_size = 0
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # least recently used first; a hit touches the file, so the order
+        # survives restarts
+        files = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if name.endswith('.part'):
+                os.remove(path)
+                continue
+            stat = os.stat(path)
+            files.append((stat.st_mtime, name, stat.st_size))
+        for mtime, name, size in sorted(files):
+            self._m_files[name] = size, mtime
+            self._m_size += size
+
+
+    @staticmethod
+    def key(server, path, size, modify):
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+        return hashlib.sha1('%s\0%s\0%d\0%d'
+                            % (server, path, size, modify)).hexdigest()
+
+
+    def _place(self, source, target):
+        if os.path.lexists(target):
+            os.remove(target)
+        if self._c_link:
+            try:
+                os.link(source, target)
+                return
+            except OSError:
+                # another file system, or one without links
+                pass
+        shutil.copyfile(source, target)
+
+
+    def _forget(self, key):
+        with self._m_lock:
+            entry = self._m_files.pop(key, None)
+            if entry is not None:
+                self._m_size -= entry[0]
+        try:
+            os.remove(os.path.join(self.directory, key))
+        except OSError:
+            pass
+
+
+    def fetch(self, key, size, target_path):
+        with self._m_lock:
+            entry = self._m_files.get(key)
+            if entry is None or entry[0] != size:
+                return False
+            self._m_files[key] = self._m_files.pop(key)
+
+        cached = os.path.join(self.directory, key)
+        try:
+            stat = os.stat(cached)
+            if (stat.st_size, stat.st_mtime) != entry:
+                # written to through a target linked to it
+                raise OSError('%s changed since it was stored' % cached)
+            os.utime(cached, None)
+            mtime = os.stat(cached).st_mtime
+            with self._m_lock:
+                if key in self._m_files:
+                    self._m_files[key] = size, mtime
+            self._place(cached, target_path)
+        except (OSError, IOError):
+            self._forget(key)
+            return False
+        return True
+
+
+    def part(self, key, size):
+        # a file in the cache directory for a download to stream its copy
+        # into, or None if it would never fit; commit() or abandon() it
+        if size > self._c_capacity:
+            return None
+        return '%s.%d.part' % (os.path.join(self.directory, key),
+                               thread.get_ident())
+
+
+    def commit(self, key, part):
+        cached = os.path.join(self.directory, key)
+        try:
+            size = os.path.getsize(part)
+            if os.path.exists(cached):
+                os.remove(cached)
+            os.rename(part, cached)
+            mtime = os.stat(cached).st_mtime
+        except OSError:
+            self.abandon(part)
+            return False
+
+        evicted = []
+        with self._m_lock:
+            self._m_size += size - self._m_files.pop(key, (0, None))[0]
+            self._m_files[key] = size, mtime
+            while self._m_size > self._c_capacity:
+                name, (evicted_size, _) = self._m_files.popitem(last=False)
+                self._m_size -= evicted_size
+                evicted.append(name)
+
+        for name in evicted:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+        return True
+
+
+    @staticmethod
+    def abandon(part):
+        try:
+            os.remove(part)
+        except OSError:
+            pass
+
+
+    def store(self, key, source_path):
+        # a copy of a finished file, for downloads that were not streamed
+        # from the start
+        part = self.part(key, os.path.getsize(source_path))
+        if part is None:
+            return False
+        try:
+            # a copy, the target stays the user's to change
+            shutil.copyfile(source_path, part)
+        except (OSError, IOError):
+            self.abandon(part)
+            return False
+        return self.commit(key, part)
+
+
+    def detach(self, target_path, keep=False):
+        # writing into a hardlinked target would change the cached copy too;
+        # keep is for resuming, the target gets a copy of its own instead
+        try:
+            if os.stat(target_path).st_nlink == 1:
+                return
+            if not keep:
+                os.remove(target_path)
+                return
+            part = '%s.%d.part' % (target_path, thread.get_ident())
+            shutil.copyfile(target_path, part)
+            os.rename(part, target_path)
+        except (OSError, IOError):
+            pass
+
+
+    @property
+    def size(self):
+        with self._m_lock:
+            return self._m_size
+
+
+    def clear(self):
+        with self._m_lock:
+            names = list(self._m_files)
+        for name in names:
+            self._forget(name)
@@ -0,0 +1,77 @@
+# encoding: utf-8
+import zlib
+import hashlib
+
+
+class CRC32(object):
+
+    name = 'crc32'
+
+    def __init__(self):
+        self._m_value = 0
+
+
+    def update(self, data):
+        self._m_value = zlib.crc32(data, self._m_value)
+
+
+    def hexdigest(self):
+        return '%08x' % (self._m_value & 0xffffffff)
+
+
+
+def normalize(algorithm):
+    return algorithm.lower().replace('-', '')
+
+
+def new(algorithm):
+    algorithm = normalize(algorithm)
+    if algorithm == 'crc32':
+        return CRC32()
+    return hashlib.new(algorithm)
+
+
+def supported(algorithm):
+    algorithm = normalize(algorithm)
+    if algorithm == 'crc32':
+        return True
+    try:
+        hashlib.new(algorithm)
+    except ValueError:
+        return False
+    return True
+
+
+def update_from_file(hasher, path, length=None, chunk=1024 * 1024):
+    with open(path, 'rb') as f:
+        while length is None or length > 0:
+            data = f.read(chunk if length is None else min(chunk, length))
+            if not data:
+                break
+            hasher.update(data)
+            if length is not None:
+                length -= len(data)
+    return hasher
+
+
+def hash_file(path, algorithm, length=None):
+    return update_from_file(new(algorithm), path, length).hexdigest()
+
+
+def parse_hash_reply(msg):
+    # 213 SHA-256 0-49 169cd22282da7f147cb491e559e9dd filename
+    parts = msg.split()
+    if len(parts) < 3:
+        return None
+    return normalize(parts[0]), parts[2].lower()
+
+
+def parse_crc_reply(msg):
+    for part in msg.split():
+        part = part.strip('.')
+        if len(part) <= 8:
+            try:
+                return 'crc32', '%08x' % int(part, 16)
+            except ValueError:
+                pass
+    return None
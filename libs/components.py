@@ -1,6 +1,7 @@
 # encoding: utf-8
 import socket
 import threading
+from bisect import bisect_left
 
 from PySide.QtCore import *
 from PySide.QtGui import *
@@ -72,12 +73,15 @@ class LoginDialog(QDialog, object):
         self.signal_reset_client.connect(self.reset_client)
 
         self.logged = False
+        self.credentials = None
 
 
     def reset_client(self, server_ip):
         try:
             self.parent().client.quit()
             self.parent().client = FTPClient(server_ip)
+            self.parent().client.listing_cache = self.parent().listing_cache
+            self.parent().client.content_cache = self.parent().content_cache
         except socket.error as e:
             pass
 
@@ -107,6 +111,7 @@ class LoginDialog(QDialog, object):
         username = self.edit_username.text()
         password = self.edit_password.text()
         server_ip = self.edit_server_ip.text()
+        self.credentials = server_ip, username, password
         self.signal_reset_client.emit(server_ip)
 
         def _():
@@ -140,12 +145,39 @@ class LoginDialog(QDialog, object):
 
 
 class FileModel(QAbstractTableModel):
+
+    FETCH_BATCH = 1000
+
     def __init__(self, entries, parent):
         super(FileModel, self).__init__(parent)
 
+        self.headers = [u'名称', u'大小', u'日期', u'所有者', u'属性']
+
+        self._m_icons = None
+        self._load(entries)
+
+
+    def _load(self, entries):
         self.entries = entries
 
-        self.headers = [u'名称', u'大小', u'日期', u'所有者', u'属性']
+        # '..' stays on top whatever the sort order or filter
+        self._m_pinned = [0] if entries and entries[0].name == '..' else []
+        self._m_rows = range(len(self._m_pinned), len(entries))
+
+        self._m_keys = {}
+        self._m_sorted = {}
+        self._m_sort = None
+        self._m_display = {}
+        self._m_names = None
+        self._m_filter = u''
+        self._m_filter_range = None
+
+        self._set_order(self._m_rows)
+
+
+    def _set_order(self, rows):
+        self._m_order = self._m_pinned + rows
+        self._m_loaded = min(len(self._m_order), self.FETCH_BATCH)
 
 
     def columnCount(self, index=QModelIndex(), *args, **kwargs):
@@ -156,41 +188,63 @@ class FileModel(QAbstractTableModel):
 
     def rowCount(self, index=QModelIndex(), *args, **kwargs):
         if not index.isValid():
-            return len(self.entries)
+            return self._m_loaded
         return 0
 
 
+    def canFetchMore(self, index=QModelIndex()):
+        return not index.isValid() and self._m_loaded < len(self._m_order)
+
+
+    def fetchMore(self, index=QModelIndex()):
+        count = min(self.FETCH_BATCH, len(self._m_order) - self._m_loaded)
+        if index.isValid() or count <= 0:
+            return
+
+        self.beginInsertRows(QModelIndex(), self._m_loaded,
+                             self._m_loaded + count - 1)
+        self._m_loaded += count
+        self.endInsertRows()
+
+
+    def _display_row(self, i):
+        display = self._m_display.get(i)
+        if display is None:
+            entry = self.entries[i]
+            if entry.is_dir():
+                size = ''
+            else:
+                size = self.to_human_readable(entry.size)
+            date = '%s-%s-%s' % (entry.year, entry.month, entry.day)
+            display = self._m_display[i] = (entry.name, size, date,
+                                             entry.owner, entry.attr)
+        return display
+
+
+    def _icon(self, is_dir):
+        if self._m_icons is None:
+            provider = QFileIconProvider()
+            self._m_icons = (provider.icon(QFileIconProvider.File),
+                             provider.icon(QFileIconProvider.Folder))
+        return self._m_icons[is_dir]
+
+
     def data(self, idx, role=Qt.DisplayRole):
         if not self.is_valid_index(idx):
             return None
 
         row, col = idx.row(), idx.column()
-        entry = self.entries[row]
+        i = self._m_order[row]
 
         if role == Qt.TextAlignmentRole:
             return Qt.AlignLeft | Qt.AlignVCenter
         elif role == Qt.DisplayRole:
-            if col == 0:
-                return entry.name
-            elif col == 3:
-                return entry.owner
-            elif col == 1:
-                if entry.is_dir():
-                    return ''
-                else:
-                    return self.to_human_readable(entry.size)
-            elif col == 4:
-                return entry.attr
-            elif col == 2:
-                return '%s-%s-%s' % (entry.year, entry.month, entry.day)
+            return self._display_row(i)[col]
         elif role == Qt.DecorationRole:
             if col == 0:
-                if entry.is_dir():
-                    return QFileIconProvider().icon(QFileIconProvider.Folder)
-                else:
-                    return QFileIconProvider().icon(QFileIconProvider.File)
+                return self._icon(self.entries[i].is_dir())
         elif role == Qt.UserRole:
-            return entry
+            return self.entries[i]
 
         return None
 
@@ -218,21 +272,138 @@ class FileModel(QAbstractTableModel):
         return self.createIndex(-1, -1)
 
 
+    def _sort_keys(self, column):
+        keys = self._m_keys.get(column)
+        if keys is not None:
+            return keys
+
+        entries = self.entries
+        if column == 1 and hasattr(entries, 'sizes'):
+            keys = entries.sizes
+        elif column == 2 and hasattr(entries, 'mtimes'):
+            keys = entries.mtimes
+        elif column == 1:
+            keys = [float(e.size) if e.size else -1 for e in entries]
+        elif column == 2:
+            keys = [(e.year, e.month, e.day) for e in entries]
+        elif column == 0 and hasattr(entries, 'name'):
+            # the name alone, display strings stay lazy
+            keys = [entries.name(i).lower() for i in xrange(len(entries))]
+        else:
+            attr = ('name', 'size', 'date', 'owner', 'attr')[column]
+            keys = [getattr(e, attr).lower() for e in entries]
+
+        self._m_keys[column] = keys
+        return keys
+
+
+    def _sorted_rows(self, column):
+        # one full permutation per column, computed once per listing
+        rows = self._m_sorted.get(column)
+        if rows is None:
+            keys = self._sort_keys(column)
+            rows = self._m_sorted[column] = sorted(self._m_rows,
+                                                   key=keys.__getitem__)
+        return rows
+
+
+    def _visible_rows(self):
+        if self._m_filter_range is None:
+            matching = None
+        else:
+            lo, hi = self._m_filter_range
+            matching = [i for _, i in self._m_names[lo:hi]]
+
+        if self._m_sort is None:
+            return sorted(matching) if matching is not None else self._m_rows
+
+        column, order = self._m_sort
+        rows = self._sorted_rows(column)
+        if matching is not None:
+            if len(matching) < len(rows) / 8:
+                keys = self._sort_keys(column)
+                rows = sorted(matching, key=keys.__getitem__)
+            else:
+                matching = set(matching)
+                rows = [i for i in rows if i in matching]
+        if order == Qt.DescendingOrder:
+            rows = rows[::-1]
+        return rows
+
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        self.layoutAboutToBeChanged.emit()
+        persistent = self.persistentIndexList()
+        targets = [self._m_order[index.row()] for index in persistent]
+
+        # the same rows in another order, so as many stay loaded
+        self._m_sort = column, order
+        self._m_order = self._m_pinned + self._visible_rows()
+
+        if persistent:
+            rows = dict((i, row) for row, i in enumerate(self._m_order))
+            moved = []
+            for index, i in zip(persistent, targets):
+                row = rows[i]
+                moved.append(self.createIndex(row, index.column())
+                             if row < self._m_loaded else QModelIndex())
+            self.changePersistentIndexList(persistent, moved)
+        self.layoutChanged.emit()
+
+
+    def set_filter(self, text):
+        text = text.lower()
+        if text == self._m_filter:
+            return
+
+        if not text:
+            self._m_filter_range = None
+        else:
+            if self._m_names is None:
+                self._m_names = sorted((self.entries[i].name.lower(), i)
+                                       for i in self._m_rows)
+
+            # a longer prefix can only narrow the range already found
+            if self._m_filter_range is not None and \
+               text.startswith(self._m_filter):
+                lo, hi = self._m_filter_range
+            else:
+                lo, hi = 0, len(self._m_names)
+            lo = bisect_left(self._m_names, (text,), lo, hi)
+            hi = bisect_left(self._m_names, (text + u'\uffff',), lo, hi)
+            self._m_filter_range = lo, hi
+        self._m_filter = text
+
+        self.beginResetModel()
+        self._set_order(self._visible_rows())
+        self.endResetModel()
+
+
     def reset_entries(self, entries):
-        self.entries = entries
-        self.reset()
+        sort, text = self._m_sort, self._m_filter
+
+        self.beginResetModel()
+        self._load(entries)
+        if sort is not None:
+            self._m_sort = sort
+            self._set_order(self._visible_rows())
+        self.endResetModel()
+
+        if text:
+            self.set_filter(text)
 
 
     A_MILLION_BYTE = 1024 * 1000
 
 
-    def to_human_readable(self, size):
+    @classmethod
+    def to_human_readable(cls, size):
         size_f = float(size)
         if size_f > 1024 * 1000 * 1000:
             human_readable_size = '%.2f GB' % (size_f /
-                                                  (self.A_MILLION_BYTE * 1000))
+                                                  (cls.A_MILLION_BYTE * 1000))
         elif size_f > 1024 * 1000:
-            human_readable_size = '%.2f MB' % (size_f / self.A_MILLION_BYTE)
+            human_readable_size = '%.2f MB' % (size_f / cls.A_MILLION_BYTE)
         elif size_f > 1024:
             human_readable_size = '%.2f kB' % (size_f / 1024)
         else:
@@ -244,8 +415,7 @@ class FileModel(QAbstractTableModel):
 class WaitDialog(QDialog, object):
 
     signal_change_label = Signal(str)
-    signal_update_progress = Signal(str, str)
-    signal_update_bar = Signal(int)
+    signal_progress = Signal(object)
     def __init__(self, parent):
         super(WaitDialog, self).__init__(parent)
 
@@ -253,7 +423,7 @@ class WaitDialog(QDialog, object):
         self.setWindowTitle(u'正在传输')
 
         label = QLabel()
-        label_progress = QLabel()
+        self.label_progress = QLabel()
         self.progress_bar = QProgressBar()
 
         self.progress_bar.setRange(0, 100)
@@ -261,7 +431,10 @@ class WaitDialog(QDialog, object):
 
         button_stop = QPushButton(u'停止')
         def _():
-            parent.client.stop = True
+            if parent.scheduler is not None:
+                parent.scheduler.cancel_all()
+            if parent.pool is not None:
+                parent.pool.stop()
         button_stop.clicked.connect(_)
 
         button_close = QPushButton(u'关闭')
@@ -272,7 +445,7 @@ class WaitDialog(QDialog, object):
         _1.addWidget(button_close)
         layout = QVBoxLayout()
         layout.addWidget(label)
-        layout.addWidget(label_progress)
+        layout.addWidget(self.label_progress)
         layout.addWidget(self.progress_bar)
         layout.addLayout(_1)
 
@@ -281,8 +454,19 @@ class WaitDialog(QDialog, object):
         self.signal_change_label.connect(
             lambda text: label.setText('<b><center>%s</center></b>' % text)
         )
-        self.signal_update_progress.connect(
-            lambda s1, s2: label_progress.setText('<center>%s / %s</center>' % (s1, s2))
-        )
-        self.signal_update_bar.connect(lambda p: self.progress_bar.setValue(p))
+        self.signal_progress.connect(self.update_progress)
+
+
+    def update_progress(self, progress):
+        text = '%s / %s' % (FileModel.to_human_readable(progress.now),
+                            FileModel.to_human_readable(progress.total))
+        if progress.rate:
+            text += ', %s/s' % FileModel.to_human_readable(progress.rate)
+        if progress.eta is not None:
+            text += ', %d:%02d' % divmod(int(progress.eta), 60)
+        self.label_progress.setText('<center>%s</center>' % text)
+
+        if progress.total:
+            self.progress_bar.setValue(int(float(progress.now) /
+                                           progress.total * 100))
 
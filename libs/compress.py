@@ -0,0 +1,84 @@
+# encoding: utf-8
+import os
+import time
+import zlib
+import threading
+
+
+class Policy(object):
+
+    # formats that are compressed already
+    SKIP_EXTENSIONS = frozenset([
+        '.gz', '.tgz', '.bz2', '.xz', '.lz', '.lzma', '.zst', '.z', '.zip',
+        '.7z', '.rar', '.jar', '.apk', '.jpg', '.jpeg', '.png', '.gif',
+        '.webp', '.mp3', '.mp4', '.m4a', '.mkv', '.avi', '.mov', '.ogg',
+        '.flac', '.pdf', '.docx', '.xlsx', '.pptx', '.iso', '.dmg'])
+    MIN_SIZE = 64 * 1024
+    SAMPLE_SIZE = 256 * 1024
+    # assumed for downloads of a kind not seen yet
+    DEFAULT_RATIO = 0.6
+    DEFAULT_DECOMPRESS_RATE = 200.0 * 1024 * 1024
+    # compression has to save at least this share of the time
+    MARGIN = 0.9
+
+    def __init__(self, mode='auto', level=1):
+        # auto, always or never
+        self.mode = mode
+        self.level = level
+
+        self._m_ratios = {}
+        self._m_decompress_rate = self.DEFAULT_DECOMPRESS_RATE
+        self._m_lock = threading.Lock()
+
+
+    @staticmethod
+    def _extension(filename):
+        return os.path.splitext(filename)[1].lower()
+
+
+    def record(self, filename, ratio, decompress_rate=None):
+        with self._m_lock:
+            ext = self._extension(filename)
+            previous = self._m_ratios.get(ext)
+            self._m_ratios[ext] = ratio if previous is None \
+                                  else 0.7 * previous + 0.3 * ratio
+            if decompress_rate:
+                self._m_decompress_rate = 0.7 * self._m_decompress_rate + \
+                                          0.3 * decompress_rate
+
+
+    def sample(self, path):
+        with open(path, 'rb') as f:
+            data = f.read(self.SAMPLE_SIZE)
+        if not data:
+            return 1.0, float('inf')
+
+        started = time.time()
+        compressed = zlib.compress(data, self.level)
+        elapsed = max(time.time() - started, 1e-6)
+        return float(len(compressed)) / len(data), len(data) / elapsed
+
+
+    def decide(self, filename, size, link_rate=None, local_path=None):
+        if self.mode != 'auto':
+            return self.mode == 'always'
+        if size < self.MIN_SIZE or \
+           self._extension(filename) in self.SKIP_EXTENSIONS:
+            return False
+
+        if local_path is not None:
+            ratio, cpu_rate = self.sample(local_path)
+        else:
+            with self._m_lock:
+                ratio = self._m_ratios.get(self._extension(filename),
+                                           self.DEFAULT_RATIO)
+                cpu_rate = self._m_decompress_rate
+
+        if not link_rate:
+            # nothing measured yet; zlib outruns most links, so go by ratio
+            return ratio < self.MARGIN
+
+        # zlib and the network run in parallel, the slower one sets the pace
+        plain = size / link_rate
+        compressed = max(size * ratio / link_rate, size / cpu_rate)
+        return compressed < plain * self.MARGIN
@@ -0,0 +1,645 @@
+# encoding: utf-8
+import os
+import sys
+import time
+import socket
+import asyncore
+import asynchat
+import logging
+import functools
+import posixpath
+from collections import deque
+
+from libs import mlsd
+from libs.ftp import FTPClient, _PASV_ADDRESS, _PWD_PATH
+from libs.listing import Listing
+
+
+class Future(object):
+
+    def __init__(self):
+        self.done = False
+        self.result = None
+        self.error = None
+
+        self._m_callbacks = []
+
+
+    def add_done_callback(self, callback):
+        if self.done:
+            callback(self)
+        else:
+            self._m_callbacks.append(callback)
+
+
+    def _finish(self):
+        self.done = True
+        callbacks, self._m_callbacks = self._m_callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+
+    def set_result(self, result):
+        if not self.done:
+            self.result = result
+            self._finish()
+
+
+    def set_error(self, error):
+        if not self.done:
+            self.error = error
+            self._finish()
+
+
+
+class Return(Exception):
+
+    def __init__(self, value=None):
+        super(Return, self).__init__()
+        self.value = value
+
+
+
+class Task(Future):
+
+    def __init__(self, gen):
+        super(Task, self).__init__()
+
+        self._m_gen = gen
+        self._step(None, None)
+
+
+    def _step(self, value, error):
+        while True:
+            try:
+                if error is not None:
+                    future = self._m_gen.throw(error)
+                else:
+                    future = self._m_gen.send(value)
+            except Return as e:
+                self.set_result(e.value)
+                return
+            except StopIteration:
+                self.set_result(None)
+                return
+            except Exception as e:
+                self.set_error(e)
+                return
+
+            if not future.done:
+                future.add_done_callback(self._wakeup)
+                return
+            value, error = future.result, future.error
+
+
+    def _wakeup(self, future):
+        self._step(future.result, future.error)
+
+
+
+def coroutine(func):
+    @functools.wraps(func)
+    def _(*args, **kwargs):
+        return Task(func(*args, **kwargs))
+    return _
+
+
+def gather(*futures):
+    ret = Future()
+    pending = [len(futures)]
+
+    def _(_):
+        pending[0] -= 1
+        if not pending[0]:
+            ret.set_result([f.error or f.result for f in futures])
+
+    if not futures:
+        ret.set_result([])
+    for future in futures:
+        future.add_done_callback(_)
+    return ret
+
+
+
+class EventLoop(object):
+
+    def __init__(self):
+        self.map = {}
+
+
+    def _expire(self):
+        now = time.time()
+        for channel in self.map.values():
+            if channel.expired(now):
+                channel.handle_timeout()
+
+
+    def run_until_complete(self, future):
+        while not future.done:
+            if not self.map:
+                raise RuntimeError('event loop has nothing left to wait on')
+            asyncore.loop(timeout=1, use_poll=True, map=self.map, count=1)
+            self._expire()
+
+        if future.error is not None:
+            raise future.error
+        return future.result
+
+
+    def close(self):
+        asyncore.close_all(map=self.map)
+
+
+
+class _Deadline(object):
+
+    # seconds a channel may go without progress while something waits on it
+    timeout = 30
+
+    def touch(self):
+        self._m_active = time.time()
+
+
+    def waiting(self):
+        return True
+
+
+    def expired(self, now):
+        return self.waiting() and now - self._m_active > self.timeout
+
+
+
+class _ControlChannel(_Deadline, asynchat.async_chat):
+
+    def __init__(self, loop, address, timeout):
+        asynchat.async_chat.__init__(self, map=loop.map)
+        self.set_terminator('\r\n')
+        self.timeout = timeout
+        self.touch()
+
+        self._m_buffer = []
+        self._m_lines = []
+        self._m_replies = deque()
+        self._m_waiters = deque()
+
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect(address)
+
+
+    def waiting(self):
+        # an idle session between commands is not late for anything
+        return self.connecting or bool(self._m_waiters)
+
+
+    def collect_incoming_data(self, data):
+        self.touch()
+        self._m_buffer.append(data)
+
+
+    def found_terminator(self):
+        line = ''.join(self._m_buffer)
+        self._m_buffer = []
+
+        self._m_lines.append(line)
+        code = self._m_lines[0][:3]
+        if line[:3] != code or line[3:4] != ' ':
+            return
+
+        lines, self._m_lines = self._m_lines, []
+        reply = ([int(code)] * len(lines),
+                 [l[4:] if l[:3] == code else l.strip() for l in lines])
+        if self._m_waiters:
+            self._m_waiters.popleft().set_result(reply)
+        else:
+            self._m_replies.append(reply)
+
+
+    def reply(self):
+        future = Future()
+        if self._m_replies:
+            future.set_result(self._m_replies.popleft())
+        elif not self.connected and not self.connecting:
+            future.set_error(socket.error('control connection closed'))
+        else:
+            if not self._m_waiters:
+                # the clock starts when someone starts waiting
+                self.touch()
+            self._m_waiters.append(future)
+        return future
+
+
+    def command(self, cmd):
+        self.push(cmd.encode('utf-8'))
+        return self.reply()
+
+
+    def _fail(self, error):
+        waiters, self._m_waiters = self._m_waiters, deque()
+        for waiter in waiters:
+            waiter.set_error(error)
+
+
+    def handle_connect(self):
+        self.touch()
+
+
+    def handle_close(self):
+        self.close()
+        self._fail(socket.error('control connection closed'))
+
+
+    def handle_error(self):
+        error = sys.exc_info()[1]
+        self.close()
+        self._fail(error)
+
+
+    def handle_timeout(self):
+        self.close()
+        self._fail(socket.timeout('no reply in %ds' % self.timeout))
+
+
+
+class _DataChannel(_Deadline, asyncore.dispatcher):
+
+    def __init__(self, loop, address, timeout, sink=None, source=None,
+                       callback=None):
+        asyncore.dispatcher.__init__(self, map=loop.map)
+        self.timeout = timeout
+        self.touch()
+
+        self._m_sink = sink
+        self._m_source = source
+        self._m_callback = callback
+        self._m_out = ''
+
+        self.transferred = 0
+        self.finished = Future()
+
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect(address)
+
+
+    def readable(self):
+        return self._m_sink is not None
+
+
+    def writable(self):
+        return self.connecting or self._m_source is not None
+
+
+    def handle_connect(self):
+        self.touch()
+
+
+    def handle_read(self):
+        data = self.recv(65536)
+        if data:
+            self.touch()
+            self._m_sink(data)
+            self.transferred += len(data)
+            if self._m_callback is not None:
+                self._m_callback(self.transferred)
+
+
+    def handle_write(self):
+        if self._m_source is None:
+            return
+
+        if not self._m_out:
+            self._m_out = self._m_source.read(65536)
+            if not self._m_out:
+                self.handle_close()
+                return
+
+        sent = self.send(self._m_out)
+        if sent:
+            self.touch()
+        self._m_out = self._m_out[sent:]
+        self.transferred += sent
+        if self._m_callback is not None:
+            self._m_callback(self.transferred)
+
+
+    def handle_close(self):
+        self.close()
+        self.finished.set_result(self.transferred)
+
+
+    def handle_error(self):
+        error = sys.exc_info()[1]
+        self.close()
+        self.finished.set_error(error)
+
+
+    def handle_timeout(self):
+        self.close()
+        self.finished.set_error(socket.timeout('no data in %ds'
+                                               % self.timeout))
+
+
+
+class AsyncFTPClient(object):
+
+    def _info(self, (codes, msgs)):
+        if self._m_logger.isEnabledFor(logging.INFO):
+            self._m_logger.info('%s: %s', codes[0], '\n     '.join(msgs))
+
+
+    def __init__(self, loop, server_ip, server_port=21, timeout=30):
+        self._c_server_ip = server_ip
+        self._c_server_port = server_port
+        # seconds to connect, or to wait for a reply or for data
+        self._c_timeout = timeout
+
+        self.loop = loop
+        self.stop = False
+        self.home = None
+
+        self._m_control = None
+        self._m_features = None
+        self._m_logger = logging.getLogger(__name__)
+
+
+    @property
+    def connected(self):
+        return self._m_control is not None and self._m_control.connected
+
+
+    def _cmd_send(self, cmd):
+        self._m_logger.info('cmd: %s', cmd.strip())
+        return self._m_control.command(cmd)
+
+
+    @coroutine
+    def connect(self):
+        self._m_control = _ControlChannel(self.loop, (self._c_server_ip,
+                                                      self._c_server_port),
+                                          self._c_timeout)
+        ret = codes, _ = yield self._m_control.reply()
+        self._info(ret)
+
+        raise Return(220 in codes)
+
+
+    @coroutine
+    def login(self, username, password):
+        ret = codes, _ = yield self._cmd_send('USER %s\r\n' % username)
+        self._info(ret)
+
+        if 331 in codes:
+            ret = codes, _ = yield self._cmd_send('PASS %s\r\n' % password)
+            self._info(ret)
+            if 230 in codes:
+                ret = codes, msgs = yield self._cmd_send('PWD\r\n')
+                self._info(ret)
+                if 257 in codes:
+                    match = _PWD_PATH.search(msgs[0])
+                    if match:
+                        self.home = match.group(1).replace('""', '"')
+                    raise Return(True)
+
+        raise Return(False)
+
+
+    @coroutine
+    def cwd(self, directory):
+        ret = codes, _ = yield self._cmd_send('CWD %s\r\n' % directory)
+        self._info(ret)
+
+        raise Return(250 in codes)
+
+
+    @coroutine
+    def size(self, filename):
+        ret = codes, msgs = yield self._cmd_send('SIZE %s\r\n' % filename)
+        self._info(ret)
+
+        if 213 in codes:
+            raise Return((True, int(msgs[0])))
+        raise Return((False, None))
+
+
+    @coroutine
+    def features(self):
+        if self._m_features is None:
+            ret = codes, msgs = yield self._cmd_send('FEAT\r\n')
+            self._info(ret)
+            self._m_features = set()
+            if 211 in codes:
+                self._m_features.update(msg.strip().upper()
+                                        for msg in msgs[1:-1])
+        raise Return(self._m_features)
+
+
+    @coroutine
+    def mlst(self, paths):
+        # like FTPClient.mlst, the commands of a batch are all in flight
+        ret = dict.fromkeys(paths)
+        features = yield self.features()
+        if not any(feature.split(' ')[0] == 'MLST' for feature in features):
+            raise Return(ret)
+
+        for start in xrange(0, len(paths), FTPClient.MLST_BATCH):
+            batch = paths[start:start + FTPClient.MLST_BATCH]
+            replies = yield gather(*[self._cmd_send('MLST %s\r\n' % path)
+                                     for path in batch])
+            for path, reply in zip(batch, replies):
+                if isinstance(reply, Exception):
+                    raise reply
+                self._info(reply)
+                codes, msgs = reply
+                if 250 in codes and len(msgs) >= 3:
+                    ret[path] = mlsd.parse_facts(msgs[1])
+        raise Return(ret)
+
+
+    @coroutine
+    def _open_data(self, sink=None, source=None, callback=None):
+        ret = codes, _ = yield self._cmd_send('TYPE I\r\n')
+        self._info(ret)
+        if 200 not in codes:
+            raise Return(None)
+
+        ret = codes, msgs = yield self._cmd_send('PASV\r\n')
+        self._info(ret)
+        if 227 not in codes:
+            raise Return(None)
+
+        t = map(int, _PASV_ADDRESS.search(msgs[0]).groups())
+        address = '%d.%d.%d.%d' % (t[0], t[1], t[2], t[3]), t[4] * 256 + t[5]
+        self._m_logger.debug('   : connecting to %s:%s', *address)
+
+        raise Return(_DataChannel(self.loop, address, self._c_timeout,
+                                  sink=sink, source=source,
+                                  callback=callback))
+
+
+    @coroutine
+    def _transfer(self, cmd, channel):
+        ret = codes, _ = yield self._cmd_send(cmd)
+        self._info(ret)
+        if 125 not in codes and 150 not in codes:
+            channel.close()
+            raise Return(False)
+
+        yield channel.finished
+        ret = codes, _ = yield self._m_control.reply()
+        self._info(ret)
+
+        raise Return(226 in codes)
+
+
+    @coroutine
+    def list(self, path=''):
+        success = yield self.cwd(path or '.')
+        if not success:
+            raise Return((False, []))
+
+        chunks = []
+        channel = yield self._open_data(sink=chunks.append)
+        if channel is None:
+            raise Return((False, []))
+
+        success = yield self._transfer('MLSD\r\n', channel)
+        if not success:
+            raise Return((False, []))
+
+        entries = Listing()
+        entries.append('..', False)
+        entries.extend(mlsd.iter_facts(chunks))
+        raise Return((True, entries))
+
+
+    @coroutine
+    def download(self, path, target_path, callback=lambda _1, _2: 1):
+        directory, filename = posixpath.split(path)
+
+        if not filename:
+            self._m_logger.error('%s is not a valid path', path)
+            raise Return(False)
+
+        success = yield self.cwd(directory or '.')
+        if not success:
+            raise Return(False)
+
+        _, size = yield self.size(filename)
+        if not size:
+            raise Return(False)
+
+        with open(target_path, 'wb') as f:
+            def _(now):
+                callback(size, now)
+                if self.stop:
+                    channel.close()
+                    channel.finished.set_result(now)
+
+            channel = yield self._open_data(sink=f.write, callback=_)
+            if channel is None:
+                raise Return(False)
+
+            success = yield self._transfer('RETR %s\r\n' % filename, channel)
+
+        self.stop = False
+        raise Return(success)
+
+
+    @coroutine
+    def upload(self, path, target_path, callback=lambda _1, _2: 1):
+        directory, filename = posixpath.split(path)
+
+        if not filename:
+            self._m_logger.error('%s is not a valid path', path)
+            raise Return(False)
+
+        success = yield self.cwd(directory or '.')
+        if not success:
+            raise Return(False)
+
+        length = os.path.getsize(target_path)
+        with open(target_path, 'rb') as f:
+            def _(now):
+                callback(length, now)
+                if self.stop:
+                    channel.handle_close()
+
+            channel = yield self._open_data(source=f, callback=_)
+            if channel is None:
+                raise Return(False)
+
+            success = yield self._transfer('STOR %s\r\n' % filename, channel)
+
+        self.stop = False
+        raise Return(success)
+
+
+    @coroutine
+    def quit(self):
+        ret = codes, _ = yield self._cmd_send('QUIT\r\n')
+        self._info(ret)
+
+        self._m_control.close()
+        raise Return(221 in codes)
+
+
+
+class _Items(deque):
+
+    put = deque.append
+
+
+
+def parallel(loop, clients, items, handle, logger, name='engine',
+             token=None):
+    # libs.mirror.parallel on one event loop: handle(client, item, queue)
+    # is a coroutine run on an idle client per item and may queue more
+    # items; the items it fails on are returned. a client that lost its
+    # connection takes no more items.
+    queue = _Items(items)
+    idle = list(clients)
+    failed = []
+    running = [0]
+    dispatching = [False]
+    done = Future()
+
+    def finished(client, item, task):
+        running[0] -= 1
+        if token is not None:
+            token.detach(client)
+        if task.error is not None:
+            logger.error('%s: %s failed, %s', name, item, task.error)
+        if task.error is not None or not task.result:
+            failed.append(item)
+        if client.connected:
+            idle.append(client)
+        dispatch()
+
+    def dispatch():
+        # handlers that finish without waiting call back in here; the
+        # outer call picks up what they changed
+        if dispatching[0]:
+            return
+        dispatching[0] = True
+        try:
+            while idle and queue:
+                item = queue.popleft()
+                if token is not None and token.cancelled:
+                    failed.append(item)
+                    continue
+                client = idle.pop()
+                running[0] += 1
+                if token is not None:
+                    token.attach(client)
+                handle(client, item, queue).add_done_callback(
+                    functools.partial(finished, client, item))
+        finally:
+            dispatching[0] = False
+
+        if not running[0]:
+            # done, or no client left for what is still queued
+            failed.extend(queue)
+            queue.clear()
+            done.set_result(failed)
+
+    dispatch()
+    return loop.run_until_complete(done)
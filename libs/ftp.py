@@ -1,30 +1,117 @@
 # encoding: utf-8
 import os
+import re
+import mmap
+import time
+import zlib
+import posixpath
+from collections import deque
 
 import socket
 import logging
-from libs.misc import DirEntry
+from libs import mlsd
+from libs import checksum
+from libs import compress
+from libs import metrics
+from libs import throttle
+from libs.listing import Listing
+from libs.writer import DiskWriter
+
+try:
+    from os import sendfile
+except ImportError:
+    try:
+        from sendfile import sendfile
+    except ImportError:
+        sendfile = None
+
+
+_PASV_ADDRESS = re.compile(r'(\d+),(\d+),(\d+),(\d+),(\d+),(\d+)')
+_PWD_PATH = re.compile(r'"(.*)"')
+
+_COMMAND_SECONDS = metrics.registry.histogram(
+    'ftp_command_seconds',
+    'time from sending a command to its first reply', ('verb',))
+_REPLIES = metrics.registry.counter(
+    'ftp_replies_total', 'first replies to commands', ('verb', 'code'))
+_DATA_CONNECT_SECONDS = metrics.registry.histogram(
+    'ftp_data_connect_seconds',
+    'time to set up a data connection', ('mode',))
+_FIRST_BYTE_SECONDS = metrics.registry.histogram(
+    'ftp_transfer_first_byte_seconds',
+    'time from the transfer command to the first data byte')
+_TRANSFER_RATE = metrics.registry.histogram(
+    'ftp_transfer_bytes_per_second', 'throughput of each transfer',
+    ('direction',), buckets=metrics.THROUGHPUT_BUCKETS)
+_TRANSFER_BYTES = metrics.registry.counter(
+    'ftp_transfer_bytes_total', 'bytes moved over data connections',
+    ('direction',))
+_WIRE_BYTES = metrics.registry.counter(
+    'ftp_transfer_wire_bytes_total',
+    'bytes on data connections after MODE Z compression', ('direction',))
+_COMPRESSION_RATIO = metrics.registry.histogram(
+    'ftp_transfer_compression_ratio',
+    'wire bytes over file bytes of MODE Z transfers', ('direction',),
+    buckets=(0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0))
+_LISTING_ENTRIES = metrics.registry.histogram(
+    'ftp_listing_entries', 'entries per directory listing',
+    buckets=metrics.SIZE_BUCKETS)
 
 
 class FTPClient(object):
 
-    def _ret(self):
-        lines, codes, msgs = [], [], []
+    SEND_CHUNK = 256 * 1024
+    LIST_BATCH = 1000
+    # MLST commands in flight at once, so the replies never fill the socket
+    # buffers while commands are still being sent
+    MLST_BATCH = 100
+
+    def _readline(self):
         while True:
+            i = self._m_buffer.find('\r\n')
+            if i >= 0:
+                line = self._m_buffer[:i]
+                self._m_buffer = self._m_buffer[i + 2:]
+                return line
+
             data = self._m_cmd_sock.recv(4096)
+            if not data:
+                raise socket.error('control connection closed')
+            self._m_buffer += data
+
+
+    def _ret(self):
+        lines = [self._readline()]
+        code = lines[0][:3]
+        if lines[0][3:4] == '-':
+            while True:
+                line = self._readline()
+                lines.append(line)
+                if line[:3] == code and line[3:4] == ' ':
+                    break
 
-            lines = data.strip().split('\r\n')
-            line = '000 '
-            for line in lines:
-                codes.append(int(line[:3]))
-                msgs.append(line[4:])
-            if line[3] == ' ':
-                return codes, msgs
+        # replies with nothing pending are the greeting or the final reply
+        # of a transfer, which are timed elsewhere
+        if self._m_pending:
+            verb, sent = self._m_pending.popleft()
+            _COMMAND_SECONDS.observe(time.time() - sent, verb)
+            _REPLIES.inc(1, verb, code)
+
+        codes = [int(code)] * len(lines)
+        msgs = [line[4:] if line[:3] == code else line.strip()
+                for line in lines]
+        return codes, msgs
+
+
+    @staticmethod
+    def _preliminary(codes):
+        return 125 in codes or 150 in codes
 
 
     def _info(self, (codes, msgs)):
-        for code, data in zip(codes, msgs):
-            self._m_logger.info('%s: %s', code, data)
+        # one record per reply, formatted only if someone listens
+        if self._m_logger.isEnabledFor(logging.INFO):
+            self._m_logger.info('%s: %s', codes[0], '\n     '.join(msgs))
 
 
     def __init__(self, server_ip, server_port=21,
@@ -35,10 +122,37 @@ class FTPClient(object):
         self._c_client_port = client_port
 
         self._m_cmd_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._m_buffer = ''
+        self._m_pending = deque()
+        self._m_sent = 0
 
         self.connected = False
 
-        logging.basicConfig(level=logging.DEBUG)
+        self._c_username = None
+        self._c_password = None
+
+        # what the server was last told, to skip commands that change nothing
+        self._m_cwd = None
+        self._m_type = None
+        # where the server put this session at login
+        self.home = None
+        self.listing_cache = None
+        self.content_cache = None
+
+        self.hash_algorithm = 'sha1'
+        self._m_unsupported = set()
+
+        # bytes per second for each transfer of this session, 0 is unlimited
+        self.rate_limit = 0
+        self._m_bucket = None
+
+        # None turns MODE Z off
+        self.compression = compress.Policy()
+        self.last_transfer = None
+        self._m_features = None
+        self._m_mode = 'S'
+        self._m_link_rate = None
+
         self._m_logger = logging.getLogger(__name__)
 
         self.stop = False
@@ -53,12 +167,33 @@ class FTPClient(object):
         self.connected = True
 
 
+    def _sent(self, cmd):
+        self._m_sent = time.time()
+        self._m_pending.append((cmd.split(' ', 1)[0].strip().upper(),
+                                self._m_sent))
+
+
     def _cmd_send(self, cmd):
-        self._m_cmd_sock.send(cmd.encode('utf-8'))
+        self._m_cmd_sock.sendall(cmd.encode('utf-8'))
+        self._sent(cmd)
         self._m_logger.info('cmd: %s', cmd.strip())
 
 
+    def pipeline(self, *cmds):
+        # all commands go out in one send; the replies are read lazily and in
+        # order, and every one of them must be consumed before the next
+        # command is sent
+        self._m_cmd_sock.sendall(''.join(cmd.encode('utf-8') for cmd in cmds))
+        for cmd in cmds:
+            self._sent(cmd)
+            self._m_logger.info('cmd: %s', cmd.strip())
+
+        return (self._ret() for _ in cmds)
+
+
     def login(self, username, password):
+        self._c_username, self._c_password = username, password
+
         self._cmd_send('USER %s\r\n' % username)
         ret = codes, msgs = self._ret()
         self._info(ret)
@@ -69,49 +204,250 @@ class FTPClient(object):
             self._info(ret)
             if 230 in codes:
                 self._cmd_send('PWD\r\n')
-                ret = codes, _ = self._ret()
+                ret = codes, msgs = self._ret()
                 self._info(ret)
                 if 257 in codes:
+                    match = _PWD_PATH.search(msgs[0])
+                    if match:
+                        self._m_cwd = match.group(1).replace('""', '"')
+                        self.home = self._m_cwd
                     return True
 
         return False
 
 
-    def passive_mode(self):
-        self._cmd_send('TYPE I\r\n')
+    def noop(self):
+        self._cmd_send('NOOP\r\n')
         ret = codes, _ = self._ret()
+
         self._info(ret)
-        if 200 not in codes:
-            return False
+        if 200 in codes:
+            return True
+        return False
+
+
+    def features(self):
+        if self._m_features is None:
+            self._cmd_send('FEAT\r\n')
+            ret = codes, msgs = self._ret()
+            self._info(ret)
+            self._m_features = set()
+            if 211 in codes:
+                self._m_features.update(msg.strip().upper()
+                                        for msg in msgs[1:-1])
+        return self._m_features
+
+
+    def mode(self, mode):
+        if mode == self._m_mode:
+            return True
+
+        self._cmd_send('MODE %s\r\n' % mode)
+        ret = codes, _ = self._ret()
 
-        self._cmd_send('PASV\r\n')
-        ret = codes, msgs = self._ret()
         self._info(ret)
+        if 200 in codes:
+            self._m_mode = mode
+            return True
+        return False
 
-        if 227 in codes:
-            t = map(int, eval(msgs[0].split()[3]))
-            server_ip = '%d.%d.%d.%d' % (t[0], t[1], t[2], t[3])
-            port = t[4] * 256 + t[5]
 
-            self._m_data_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self._m_data_sock.connect((server_ip, port))
-            self._m_logger.debug('   : connected to %s:%s', server_ip, port)
+    def _link_rate(self):
+        if self._c_server_ip.startswith('127.') or \
+           self._c_server_ip == 'localhost':
+            return float('inf')
+        return self._m_link_rate
+
 
+    def _select_mode(self, filename, size, local_path=None):
+        # MODE Z only when the policy expects it to finish sooner
+        if self.compression is not None and \
+           'MODE Z' in self.features() and \
+           self.compression.decide(filename, size, self._link_rate(),
+                                   local_path) and \
+           self.mode('Z'):
             return True
+        self.mode('S')
+        return False
+
 
+    def binary(self):
+        if self._m_type == 'I':
+            return True
+
+        self._cmd_send('TYPE I\r\n')
+        ret = codes, _ = self._ret()
+
+        self._info(ret)
+        if 200 in codes:
+            self._m_type = 'I'
+            return True
         return False
 
 
+    def pasv(self):
+        # (ip, port) the server listens on for the next transfer
+        if self._m_type == 'I':
+            cmds = ['PASV\r\n']
+        else:
+            cmds = ['TYPE I\r\n', 'PASV\r\n']
+
+        replies = list(self.pipeline(*cmds))
+        for reply in replies:
+            self._info(reply)
+        if len(replies) > 1:
+            if 200 not in replies[0][0]:
+                return None
+            self._m_type = 'I'
+
+        codes, msgs = replies[-1]
+        if 227 in codes:
+            t = map(int, _PASV_ADDRESS.search(msgs[0]).groups())
+            return '%d.%d.%d.%d' % (t[0], t[1], t[2], t[3]), t[4] * 256 + t[5]
+        return None
+
+
+    def passive_mode(self):
+        started = time.time()
+        address = self.pasv()
+        if address is None:
+            return False
+
+        self._m_data_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._m_data_sock.connect(address)
+        self._m_logger.debug('   : connected to %s:%s', *address)
+        _DATA_CONNECT_SECONDS.observe(time.time() - started, 'pasv')
+        return True
+
+
+    def _absolute(self, directory):
+        directory = directory or '.'
+        if directory.startswith('/'):
+            return posixpath.normpath(directory)
+        if self._m_cwd is None:
+            return None
+        return posixpath.normpath(posixpath.join(self._m_cwd, directory))
+
+
+    def _is_cwd(self, directory):
+        target = self._absolute(directory)
+        return target is not None and target == self._m_cwd
+
+
     def cwd(self, directory):
+        if self._is_cwd(directory):
+            return True
+
         self._cmd_send('CWD %s\r\n' % directory)
         ret = codes, msgs = self._ret()
 
         self._info(ret)
         if 250 in codes:
+            self._moved_to(directory)
+            return True
+        return False
+
+
+    def mkd(self, directory):
+        self._cmd_send('MKD %s\r\n' % directory)
+        ret = codes, _ = self._ret()
+
+        self._info(ret)
+        if 257 in codes:
+            self._invalidate(directory.rstrip('/'))
+            return True
+        return False
+
+
+    def dele(self, filename):
+        self._cmd_send('DELE %s\r\n' % filename)
+        ret = codes, _ = self._ret()
+
+        self._info(ret)
+        self._invalidate(filename)
+        return 250 in codes
+
+
+    def mfmt(self, filename, modify):
+        self._cmd_send('MFMT %s %s\r\n' % (modify, filename))
+        ret = codes, _ = self._ret()
+
+        self._info(ret)
+        if 213 in codes:
             return True
         return False
 
 
+    def _moved_to(self, directory):
+        if directory.startswith('/'):
+            self._m_cwd = posixpath.normpath(directory)
+        elif self._m_cwd is not None:
+            self._m_cwd = posixpath.normpath(posixpath.join(self._m_cwd,
+                                                            directory))
+
+
+    def _invalidate(self, filename):
+        directory = self._absolute(posixpath.dirname(filename))
+
+        if self.listing_cache is None:
+            return
+        if directory is not None:
+            self.listing_cache.invalidate(directory)
+        else:
+            self.listing_cache.invalidate()
+
+
+    def facts(self, path):
+        # (size, modify) of a file from a recent listing of its directory;
+        # only the shared cache is trusted, every session invalidates it
+        directory, filename = posixpath.split(path)
+        directory = self._absolute(directory)
+        if directory is None:
+            return None
+
+        if self.listing_cache is None:
+            return None
+        entries = self.listing_cache.get(directory)
+        if entries is None or not hasattr(entries, 'find'):
+            return None
+
+        i = entries.find(filename)
+        if i is None or not entries.is_file(i) or entries.sizes[i] < 0:
+            return None
+        return int(entries.sizes[i]), int(entries.mtimes[i])
+
+
+    def sizes(self, filenames):
+        ret = {}
+        for filename, reply in zip(filenames,
+                                   self.pipeline(*['SIZE %s\r\n' % filename
+                                                   for filename in filenames])):
+            self._info(reply)
+            codes, msgs = reply
+            ret[filename] = int(msgs[0]) if 213 in codes else None
+        return ret
+
+
+    def mlst(self, paths):
+        # facts of single paths over the control connection, no data
+        # connection needed; None where the server has none to give
+        ret = dict.fromkeys(paths)
+        if not any(feature.split(' ')[0] == 'MLST'
+                   for feature in self.features()):
+            return ret
+
+        for start in xrange(0, len(paths), self.MLST_BATCH):
+            batch = paths[start:start + self.MLST_BATCH]
+            for path, reply in zip(batch,
+                                   self.pipeline(*['MLST %s\r\n' % path
+                                                   for path in batch])):
+                self._info(reply)
+                codes, msgs = reply
+                if 250 in codes and len(msgs) >= 3:
+                    ret[path] = mlsd.parse_facts(msgs[1])
+        return ret
+
+
     def size(self, filename):
         self._cmd_send('SIZE %s\r\n' % filename)
         ret = codes, msgs = self._ret()
@@ -122,7 +458,193 @@ class FTPClient(object):
         return False, None
 
 
-    def retrieve(self, filename, target_path, size, callback, passive=False):
+    def rest(self, offset):
+        self._cmd_send('REST %d\r\n' % offset)
+        ret = codes, _ = self._ret()
+
+        self._info(ret)
+        if 350 in codes:
+            return True
+        return False
+
+
+    def clone(self):
+        client = FTPClient(self._c_server_ip, self._c_server_port)
+        client.listing_cache = self.listing_cache
+        client.content_cache = self.content_cache
+        client.rate_limit = self.rate_limit
+        client.connect()
+        if not client.login(self._c_username, self._c_password):
+            client.quit()
+            return None
+
+        return client
+
+
+    def retrieve_range(self, filename, target_path, offset, length, callback,
+                       passive=True):
+        self.mode('S')
+        if offset and not self.rest(offset):
+            return False
+
+        self._cmd_send('RETR %s\r\n' % filename)
+        ret = codes, _ = self._ret()
+        self._info(ret)
+        if not self._preliminary(codes):
+            return False
+
+        if not passive:
+            conn, _ = self._m_data_sock.accept()
+        else:
+            conn = self._m_data_sock
+
+        writer = DiskWriter(target_path, offset=offset)
+        writer.start()
+        try:
+            received = self._receive(conn, writer, length, callback,
+                                     limit=length)
+        finally:
+            writer.close()
+
+        # closing the data connection early makes the server abort the rest
+        # of the file, so the reply may be 426 as well as 226
+        conn.close()
+        if not passive:
+            self._m_data_sock.close()
+
+        self._info(self._ret())
+
+        return received == length and writer.error is None
+
+
+    def set_rate_limit(self, rate):
+        self.rate_limit = rate
+        bucket = self._m_bucket
+        if bucket is not None:
+            bucket.set_rate(rate)
+
+
+    def _throttle(self):
+        self._m_bucket = throttle.TokenBucket(self.rate_limit)
+        return throttle.Throttle(self._m_bucket,
+                                 throttle.server_bucket(self._c_server_ip),
+                                 throttle.process)
+
+
+    def _receive(self, conn, writer, total, callback, limit=None, start=0):
+        pace = self._throttle()
+        started = time.time()
+        received = 0
+        while limit is None or received < limit:
+            buf = writer.acquire()
+            if limit is None:
+                n = conn.recv_into(buf, pace.chunk(len(buf)))
+            else:
+                n = conn.recv_into(buf, pace.chunk(min(len(buf),
+                                                       limit - received)))
+            if not n:
+                writer.release(buf)
+                break
+
+            writer.submit(buf, n)
+            pace.consume(n)
+            if not received:
+                _FIRST_BYTE_SECONDS.observe(time.time() - self._m_sent)
+            received += n
+            callback(total, start + received)
+            if self.stop:
+                break
+
+        self._observe_transfer('in', received, started)
+        return received
+
+
+    @staticmethod
+    def _submit(writer, data):
+        view = memoryview(data)
+        while view:
+            buf = writer.acquire()
+            n = min(len(buf), len(view))
+            buf[:n] = view[:n]
+            writer.submit(buf, n)
+            view = view[n:]
+
+
+    def _receive_compressed(self, conn, writer, total, callback, start=0):
+        pace = self._throttle()
+        started = time.time()
+        inflate = zlib.decompressobj()
+        wire = bytearray(self.SEND_CHUNK)
+
+        received = written = 0
+        inflating = 0.0
+        while True:
+            n = conn.recv_into(wire, pace.chunk(len(wire)))
+            if not n:
+                break
+            pace.consume(n)
+            if not received:
+                _FIRST_BYTE_SECONDS.observe(time.time() - self._m_sent)
+            received += n
+
+            # bounded output per call, a tiny chunk may inflate to megabytes
+            data = buffer(wire, 0, n)
+            while data:
+                t = time.time()
+                out = inflate.decompress(data, writer.buffer_size)
+                inflating += time.time() - t
+                data = inflate.unconsumed_tail
+                if not out:
+                    break
+                self._submit(writer, out)
+                written += len(out)
+
+            callback(total, start + written)
+            if self.stop:
+                break
+
+        if not self.stop:
+            out = inflate.flush()
+            self._submit(writer, out)
+            written += len(out)
+
+        self._observe_transfer('in', written, started, wire=received,
+                               codec_time=inflating)
+        return written
+
+
+    def _observe_transfer(self, direction, length, started, wire=None,
+                          codec_time=None):
+        elapsed = time.time() - started
+        compressed = wire is not None
+        if not compressed:
+            wire = length
+
+        _TRANSFER_BYTES.inc(length, direction)
+        _WIRE_BYTES.inc(wire, direction)
+        if length and elapsed > 0:
+            _TRANSFER_RATE.observe(length / elapsed, direction)
+        if compressed and length:
+            _COMPRESSION_RATIO.observe(float(wire) / length, direction)
+
+        # wire throughput of big enough transfers feeds the MODE Z policy
+        if wire >= compress.Policy.MIN_SIZE and elapsed > 0:
+            rate = wire / elapsed
+            self._m_link_rate = rate if self._m_link_rate is None \
+                                else 0.7 * self._m_link_rate + 0.3 * rate
+
+        self.last_transfer = {
+            'direction': direction,
+            'bytes': length,
+            'wire_bytes': wire,
+            'ratio': float(wire) / length if length else 1.0,
+            'compressed': compressed,
+            'elapsed': elapsed,
+            'codec_rate': length / codec_time if codec_time else None}
+
+
+    def retrieve(self, filename, target_path, size, callback, passive=False,
+                 offset=0, hasher=None, compressed=False, copy_path=None):
         self._cmd_send('RETR %s\r\n' % filename)
         ret = codes, msgs = self._ret()
 
@@ -131,20 +653,24 @@ class FTPClient(object):
         else:
             conn = self._m_data_sock
 
-        if 150 in codes:
+        if self._preliminary(codes):
             self._info(ret)
 
-            with open(target_path, 'wb') as f:
-                while True:
-                    data = conn.recv(4096)
-                    if not data:
-                        break
-                    f.write(data)
-                    callback(size, f.tell())
-                    if self.stop:
-                        break
+            if offset:
+                writer = DiskWriter(target_path, offset=offset, hasher=hasher)
+            else:
+                writer = DiskWriter(target_path, size=size, hasher=hasher,
+                                    copy_path=copy_path)
+            writer.start()
+            try:
+                if compressed:
+                    self._receive_compressed(conn, writer, size, callback,
+                                             start=offset)
                 else:
-                    self.stop = False
+                    self._receive(conn, writer, size, callback, start=offset)
+            finally:
+                writer.close()
+            self.stop = False
 
             conn.close()
             if not passive:
@@ -152,14 +678,14 @@ class FTPClient(object):
 
             ret = codes, _ = self._ret()
             self._info(ret)
-            if 226 in codes:
+            if 226 in codes and writer.error is None:
                 return True
 
         return False
 
 
     def download(self, path, target_path, passive=True,
-                 callback=lambda _1, _2: 1):
+                 callback=lambda _1, _2: 1, resume=False, verify=False):
         directory, filename = os.path.split(path)
 
         if not filename:
@@ -168,43 +694,204 @@ class FTPClient(object):
 
         if not directory:
             directory = '.'
-        if not self.cwd(directory):
-            return False
 
-        _, size = self.size(filename)
+        # CWD and SIZE only go out when the session state and a recent
+        # listing cannot answer them
+        move = not self._is_cwd(directory)
+        facts = self.facts(path)
+        cmds = []
+        if move:
+            cmds.append('CWD %s\r\n' % directory)
+        if facts is None:
+            cmds.append('SIZE %s\r\n' % filename)
+            if self.content_cache is not None:
+                cmds.append('MDTM %s\r\n' % filename)
+
+        replies = list(self.pipeline(*cmds)) if cmds else []
+        for reply in replies:
+            self._info(reply)
+        if move:
+            if 250 not in replies.pop(0)[0]:
+                return False
+            self._moved_to(directory)
+
+        if facts is None:
+            codes, msgs = replies.pop(0)
+            if 213 not in codes:
+                return False
+            size, modify = int(msgs[0]), None
+            if self.content_cache is not None:
+                codes, msgs = replies.pop(0)
+                if 213 in codes and msgs[0][:14].isdigit():
+                    modify = int(msgs[0][:14])
+        else:
+            size, modify = facts
         if not size:
             return False
 
-        if passive:
-            self.passive_mode()
-        else:
-            self.port_mode()
+        key = None
+        if self.content_cache is not None and modify and \
+           self._m_cwd is not None:
+            key = self.content_cache.key(
+                '%s@%s:%d' % (self._c_username, self._c_server_ip,
+                              self._c_server_port),
+                posixpath.join(self._m_cwd, filename), size, modify)
+            if self.content_cache.fetch(key, size, target_path):
+                self._m_logger.info('   : %s served from the local cache',
+                                    filename)
+                callback(size, size)
+                return True
 
-        if not self.retrieve(filename, target_path, passive=passive,
-                             callback=callback, size=size):
+        offset = 0
+        if resume and os.path.isfile(target_path):
+            offset = os.path.getsize(target_path)
+            # a file of full length may be a preallocated one left by a
+            # killed download; it only counts as done once it is verified
+            if offset > size or (offset == size and not verify):
+                offset = 0
+
+        hasher = checksum.new(self.hash_algorithm) if verify else None
+        if offset and hasher is not None:
+            checksum.update_from_file(hasher, target_path, offset)
+
+        part = None
+        if offset < size:
+            if self.content_cache is not None:
+                self.content_cache.detach(target_path, keep=bool(offset))
+
+            compressed = False
+            if offset:
+                # restart offsets under MODE Z differ between servers
+                self.mode('S')
+            else:
+                compressed = self._select_mode(filename, size)
+
+            if passive:
+                self.passive_mode()
+            else:
+                self.port_mode()
+
+            if offset and not self.rest(offset):
+                offset = 0
+                hasher = checksum.new(self.hash_algorithm) if verify else None
+
+            # a whole file is copied into the cache as it arrives
+            if key is not None and not offset:
+                part = self.content_cache.part(key, size)
+            try:
+                success = self.retrieve(filename, target_path,
+                                        passive=passive, callback=callback,
+                                        size=size, offset=offset,
+                                        hasher=hasher, compressed=compressed,
+                                        copy_path=part)
+            except Exception:
+                if part is not None:
+                    self.content_cache.abandon(part)
+                raise
+            if not success:
+                if part is not None:
+                    self.content_cache.abandon(part)
+                return False
+
+            if compressed:
+                self.compression.record(filename,
+                                        self.last_transfer['ratio'],
+                                        self.last_transfer['codec_rate'])
+
+        if verify and not self._verify(filename, target_path, hasher):
+            # resuming would only append to the same bad bytes, so the next
+            # attempt has to start over
+            try:
+                os.remove(target_path)
+            except OSError:
+                pass
+            if part is not None:
+                self.content_cache.abandon(part)
             return False
+        if part is not None and os.path.isfile(part) and \
+           os.path.getsize(part) == size:
+            self.content_cache.commit(key, part)
+        elif key is not None:
+            # resumed, or the streamed copy could not be written
+            if part is not None:
+                self.content_cache.abandon(part)
+            self.content_cache.store(key, target_path)
+        return True
+
+
+    def checksum(self, filename):
+        for cmd, parse in (('HASH', checksum.parse_hash_reply),
+                           ('XCRC', checksum.parse_crc_reply)):
+            if cmd in self._m_unsupported:
+                continue
+
+            self._cmd_send('%s %s\r\n' % (cmd, filename))
+            ret = codes, msgs = self._ret()
+            self._info(ret)
+            if 213 in codes or 250 in codes:
+                result = parse(msgs[-1])
+                if result is not None:
+                    return result
+            elif 500 in codes or 502 in codes or 504 in codes:
+                self._m_unsupported.add(cmd)
+
+        return None
+
+
+    def _verify(self, filename, local_path, hasher):
+        remote = self.checksum(filename)
+        if remote is None:
+            self._m_logger.warning('%s: no checksum from server, not verified',
+                                   filename)
+            return True
+
+        algorithm, digest = remote
+        if algorithm == checksum.normalize(hasher.name):
+            local = hasher.hexdigest()
+        elif checksum.supported(algorithm):
+            local = checksum.hash_file(local_path, algorithm)
+        else:
+            self._m_logger.warning('%s: unknown checksum %s, not verified',
+                                   filename, algorithm)
+            return True
 
+        if local != digest:
+            self._m_logger.error('%s: %s mismatch, local %s, server %s',
+                                 filename, algorithm, local, digest)
+            return False
         return True
 
 
-    def port_mode(self):
-        self._m_data_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._m_data_sock.bind((self._c_client_ip, self._c_client_port))
-        self._m_data_sock.listen(64)
+    def port(self, (ip, port)):
+        # the server connects to ip:port for the next transfer
+        if not self.binary():
+            return False
 
-        h1, h2, h3, h4 = self._c_client_ip.split('.')
-        p1, p2 = self._c_client_port / 256, self._c_client_port % 256
+        h1, h2, h3, h4 = ip.split('.')
+        p1, p2 = port / 256, port % 256
         self._cmd_send('PORT %s,%s,%s,%s,%s,%s\r\n' % (h1, h2, h3, h4, p1, p2))
 
         ret = codes, _ = self._ret()
         self._info(ret)
-        if 200 not in codes:
+        return 200 in codes
+
+
+    def port_mode(self):
+        started = time.time()
+
+        self._m_data_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._m_data_sock.bind((self._c_client_ip, self._c_client_port))
+        self._m_data_sock.listen(64)
+
+        if not self.port((self._c_client_ip, self._c_client_port)):
             return False
+        # the server connects back only once the transfer command is sent
+        _DATA_CONNECT_SECONDS.observe(time.time() - started, 'port')
         return True
 
 
     def upload(self, path, target_path, passive=True,
-               callback=lambda _1, _2: 1):
+               callback=lambda _1, _2: 1, resume=False, verify=False):
         directory, filename = os.path.split(path)
 
         if not filename:
@@ -216,22 +903,47 @@ class FTPClient(object):
         if not self.cwd(directory):
             return False
 
+        offset = 0
+        if resume:
+            _, remote_size = self.size(filename)
+            if remote_size and remote_size <= os.path.getsize(target_path):
+                offset = remote_size
+
+        hasher = checksum.new(self.hash_algorithm) if verify else None
+        if offset and hasher is not None:
+            checksum.update_from_file(hasher, target_path, offset)
+
+        compressed = False
+        if offset:
+            self.mode('S')
+        else:
+            compressed = self._select_mode(filename,
+                                           os.path.getsize(target_path),
+                                           local_path=target_path)
+
         if passive:
             self.passive_mode()
         else:
             self.port_mode()
 
         if not self.send_file(target_path, filename, passive=passive,
-                              callback=callback):
+                              callback=callback, offset=offset,
+                              hasher=hasher, compressed=compressed):
             return False
 
+        if verify and not self._verify(filename, target_path, hasher):
+            # as with downloads, a bad copy is not something to resume
+            self.dele(filename)
+            return False
         return True
 
 
-    def send_file(self, target_path, filename, callback, passive=True):
-        self._cmd_send('STOR %s\r\n' % filename)
+    def send_file(self, target_path, filename, callback, passive=True,
+                  offset=0, hasher=None, compressed=False):
+        # APPE continues a partial upload where REST + STOR is not supported
+        self._cmd_send('%s %s\r\n' % ('APPE' if offset else 'STOR', filename))
         ret = codes, _ = self._ret()
-        if 150 not in codes:
+        if not self._preliminary(codes):
             return False
         self._info(ret)
 
@@ -241,31 +953,98 @@ class FTPClient(object):
             conn = self._m_data_sock
 
         with open(target_path, 'rb') as f:
-            f.seek(0, os.SEEK_END)
-            length = f.tell()
-            f.seek(0, os.SEEK_SET)
-
-            bytes_sent = 0
-            while bytes_sent < length:
-                sent = conn.send(f.read(51200))
-                bytes_sent += sent
-                callback(length, bytes_sent)
-                if self.stop:
-                    break
+            length = os.fstat(f.fileno()).st_size
+            if compressed:
+                bytes_sent = self._send_compressed(conn, f, length, callback,
+                                                   hasher=hasher)
             else:
-                self.stop = False
+                bytes_sent = self._send_stream(conn, f, length, callback,
+                                               offset=offset, hasher=hasher)
+            self.stop = False
 
             conn.close()
             if not passive:
                 self._m_data_sock.close()
 
             ret = codes, _ = self._ret()
-            if 226 in codes:
+            self._invalidate(filename)
+            if 226 in codes and bytes_sent == length:
                 self._info(ret)
                 return True
             return False
 
 
+    def _send_stream(self, conn, f, length, callback, offset=0,
+                     hasher=None):
+        position = offset
+        if position >= length:
+            return position
+
+        # without sendfile, send slices of a read-only mapping of the file so
+        # no chunk is copied into a new string, and resend whatever a short
+        # send() left behind; the mapping also feeds the checksum
+        m = None
+        if sendfile is None or hasher is not None:
+            m = mmap.mmap(f.fileno(), length, access=mmap.ACCESS_READ)
+        out_fd, in_fd = conn.fileno(), f.fileno()
+        pace = self._throttle()
+        started = time.time()
+        try:
+            while position < length and not self.stop:
+                chunk = pace.chunk(self.SEND_CHUNK)
+                if sendfile is not None:
+                    sent = sendfile(out_fd, in_fd, position,
+                                    min(chunk, length - position))
+                else:
+                    sent = conn.send(buffer(m, position, chunk))
+                if not sent:
+                    break
+                pace.consume(sent)
+                if hasher is not None:
+                    hasher.update(buffer(m, position, sent))
+                position += sent
+                callback(length, position)
+        finally:
+            if m is not None:
+                m.close()
+        self._observe_transfer('out', position - offset, started)
+        return position
+
+
+    def _send_compressed(self, conn, f, length, callback, hasher=None):
+        position = sent = 0
+        if not length:
+            return position
+
+        m = mmap.mmap(f.fileno(), length, access=mmap.ACCESS_READ)
+        deflate = zlib.compressobj(self.compression.level)
+        pace = self._throttle()
+        started = time.time()
+        deflating = 0.0
+        try:
+            while position < length and not self.stop:
+                chunk = buffer(m, position, pace.chunk(self.SEND_CHUNK))
+                if hasher is not None:
+                    hasher.update(chunk)
+                t = time.time()
+                data = deflate.compress(chunk)
+                if len(chunk) == length - position:
+                    data += deflate.flush()
+                deflating += time.time() - t
+
+                if data:
+                    conn.sendall(data)
+                    pace.consume(len(data))
+                    sent += len(data)
+                position += len(chunk)
+                callback(length, position)
+        finally:
+            m.close()
+        self._observe_transfer('out', position, started, wire=sent,
+                               codec_time=deflating)
+        return position
+
+
     def __enter__(self):
         self.connect()
 
@@ -286,39 +1065,28 @@ class FTPClient(object):
 
     @staticmethod
     def _process_list(buf):
-        lines = buf.strip('\r\n').split('\r\n')
-        ret = []
-        for line in lines:
-            if not line:
-                continue
+        return list(mlsd.parse([buf]))
 
-            attrs = line.split(';')
-            _, type_ = attrs[0].split('=')
-            _, time = attrs[1].split('=')
-            year = time[0:4]
-            month = time[4:6]
-            day = time[6:8]
-            hour = time[8:10]
-            minute = time[10:12]
-            second = time[12:]
-            if type_ == 'file':
-                _, size = attrs[2].split('=')
-                name = attrs[3][1:]
-            else:
-                size = ''
-                name = attrs[2][1:]
 
-            ret.append(DirEntry(year=year, month=month, day=day,
-                                hour=hour, minute=minute, second=second,
-                                name=name, is_file=(type_ == 'file'),
-                                size=size))
-        return ret
+    def _recv_chunks(self, conn):
+        while True:
+            buf = conn.recv(65536)
+            if not buf:
+                break
+            yield buf
+
 
+    def list(self, path='', passive=True, refresh=False, callback=None):
+        cached = self.listing_cache is not None and path.startswith('/')
+        if cached and not refresh:
+            entries = self.listing_cache.get(path)
+            if entries is not None:
+                return True, entries
 
-    def list(self, path='', passive=True):
         success = self.cwd(path)
         if not success:
             return False, []
+        self.mode('S')
 
         if passive:
             self.passive_mode()
@@ -330,31 +1098,34 @@ class FTPClient(object):
         self._cmd_send('MLSD\r\n')
         ret = codes, _ = self._ret()
         self._info(ret)
-        if 150 not in codes:
+        if not self._preliminary(codes):
             return False, []
 
-        ret = ''
-        while True:
-            buf = conn.recv(4096)
-            if not buf:
-                break
-            ret += buf
-
-        entries = []
-        entries.append(DirEntry(name='..', is_file=False))
-        entries += self._process_list(ret)
+        entries = Listing()
+        entries.append('..', False)
+        reported = 0
+        for facts in mlsd.iter_facts(self._recv_chunks(conn)):
+            entries.append(*facts)
+            if callback is not None and \
+               len(entries) - reported >= self.LIST_BATCH:
+                callback(entries[reported:])
+                reported = len(entries)
+        if callback is not None and len(entries) > reported:
+            callback(entries[reported:])
 
         ret = codes, _ = self._ret()
         self._info(ret)
         if 226 not in codes:
-            print 'asdfasdfasdf'
             return False, []
 
         conn.close()
         if not passive:
             self._m_data_sock.close()
-        self._m_logger.info(entries)
+        self._m_logger.debug('   : %d entries in %s', len(entries) - 1, path)
+        _LISTING_ENTRIES.observe(len(entries) - 1)
 
+        if cached:
+            self.listing_cache.put(path, entries)
         return True, entries
 
 
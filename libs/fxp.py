@@ -0,0 +1,194 @@
+# encoding: utf-8
+import time
+import select
+import logging
+import posixpath
+
+from libs.progress import ProgressReporter
+
+
+class FXP(object):
+
+    # seconds between progress polls while both servers are busy
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, source, target, monitor=None):
+        # logged in sessions; the source listens, the target connects to it
+        # and the data never passes through this client
+        self.source = source
+        self.target = target
+        # another session on the target server, asked for the size of the
+        # file being written; without one progress is only reported at the
+        # end
+        self.monitor = monitor
+
+        self._m_logger = logging.getLogger(__name__)
+
+
+    @staticmethod
+    def _ready(clients, timeout):
+        # sessions with a whole reply line buffered or data waiting
+        ready = [client for client in clients if '\r\n' in client._m_buffer]
+        if ready:
+            return ready
+        readable, _, _ = select.select([client._m_cmd_sock
+                                        for client in clients], [], [],
+                                       timeout)
+        return [client for client in clients
+                if client._m_cmd_sock in readable]
+
+
+    @staticmethod
+    def _absolute(client, path):
+        # relative to where client is now, before any cwd of a transfer;
+        # a trailing / of a target directory stays
+        if not path or client._m_cwd is None:
+            return path
+        absolute = posixpath.normpath(posixpath.join(client._m_cwd, path))
+        return absolute + '/' if path.endswith('/') and absolute != '/' \
+               else absolute
+
+
+    def _size(self, path):
+        # the source session is in the directory of path already
+        facts = self.source.facts(path)
+        if facts is not None:
+            return facts[0]
+        success, size = self.source.size(posixpath.basename(path))
+        return size if success else None
+
+
+    def _progress(self, path, size, callback):
+        if self.monitor is None:
+            return
+        success, now = self.monitor.size(path)
+        if success:
+            callback(size, min(now, size))
+
+
+    def _abort(self, clients):
+        for client in clients:
+            client._cmd_send('ABOR\r\n')
+
+
+    def transfer(self, source_path, target_path=None,
+                 callback=lambda _1, _2: 1, size=None):
+        source_path = self._absolute(self.source, source_path)
+        target_path = self._absolute(self.target, target_path)
+        if not target_path or target_path.endswith('/'):
+            target_path = posixpath.join(target_path or '',
+                                         posixpath.basename(source_path))
+        source_dir, source_name = posixpath.split(source_path)
+        target_dir, target_name = posixpath.split(target_path)
+        if not source_name or not target_name:
+            self._m_logger.error('fxp: %s -> %s is not a file', source_path,
+                                 target_path)
+            return False
+
+        if not self.source.cwd(source_dir or '.') or \
+           not self.target.cwd(target_dir or '.'):
+            return False
+        if size is None:
+            size = self._size(source_path)
+            if size is None:
+                return False
+
+        # MODE Z would need both servers to agree on it
+        if not self.source.mode('S') or not self.target.mode('S'):
+            return False
+
+        address = self.source.pasv()
+        if address is None:
+            return False
+        if not self.target.port(address):
+            self._m_logger.error('fxp: target refused PORT %s:%d, it may not '
+                                 'allow server to server transfers', *address)
+            return False
+
+        started = time.time()
+        self.target._cmd_send('STOR %s\r\n' % target_name)
+        ret = codes, _ = self.target._ret()
+        self.target._info(ret)
+        if not self.target._preliminary(codes):
+            return False
+
+        self.source._cmd_send('RETR %s\r\n' % source_name)
+        ret = codes, _ = self.source._ret()
+        self.source._info(ret)
+        if not self.source._preliminary(codes):
+            # the target holds a data connection nobody will write to
+            self._abort([self.target])
+            for _ in xrange(2):
+                self.target._info(self.target._ret())
+            return False
+
+        monitored = posixpath.join(self.target._m_cwd, target_name) \
+                    if self.target._m_cwd is not None else target_path
+        callback(size, 0)
+
+        # the servers move the data; only their final replies are read here
+        pending = [self.source, self.target]
+        replies, aborted = {}, []
+        while pending:
+            if not aborted and (self.source.stop or self.target.stop):
+                aborted = list(pending)
+                self._abort(aborted)
+
+            ready = self._ready(pending, self.POLL_INTERVAL)
+            for client in ready:
+                replies[client] = ret = client._ret()
+                client._info(ret)
+                pending.remove(client)
+            if not ready:
+                self._progress(monitored, size, callback)
+
+        # ABOR has a reply of its own after the one of the transfer
+        for client in aborted:
+            client._info(client._ret())
+        self.source.stop = self.target.stop = False
+
+        self.target._invalidate(target_name)
+        success = not aborted and \
+                  all(226 in replies[client][0] or 250 in replies[client][0]
+                      for client in (self.source, self.target))
+        if success:
+            elapsed = max(time.time() - started, 1e-6)
+            self._m_logger.info('fxp: %s -> %s, %d bytes in %.2fs, '
+                                '%.1f KB/s', source_path, target_path, size,
+                                elapsed, size / elapsed / 1024)
+            callback(size, size)
+        return success
+
+
+    def transfer_many(self, pairs, callback=lambda _: 1):
+        # pairs of (source path, target path or directory ending in /);
+        # callback gets the overall progress like Mirror's
+        pairs = [(self._absolute(self.source, source_path),
+                  self._absolute(self.target, target_path))
+                 for source_path, target_path in pairs]
+        sizes = {}
+        for source_path, _ in pairs:
+            if self.source.cwd(posixpath.dirname(source_path) or '.'):
+                sizes[source_path] = self._size(source_path)
+        total = sum(size or 0 for size in sizes.values())
+        done = [0]
+        progress = ProgressReporter(callback)
+
+        started = time.time()
+        failed = []
+        for source_path, target_path in pairs:
+            def _(_, now):
+                progress(total, done[0] + now)
+
+            size = sizes.get(source_path)
+            if self.transfer(source_path, target_path, callback=_,
+                             size=size):
+                done[0] += size or 0
+            else:
+                failed.append(source_path)
+        progress.finish()
+
+        return {'transferred': len(pairs) - len(failed),
+                'failed': failed,
+                'bytes': done[0],
+                'elapsed': time.time() - started}
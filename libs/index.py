@@ -0,0 +1,365 @@
+# encoding: utf-8
+import os
+import re
+import time
+import sqlite3
+import logging
+import posixpath
+import threading
+from collections import namedtuple
+
+from libs import engine
+from libs.engine import AsyncFTPClient, EventLoop, Return, coroutine, gather
+
+
+IndexEntry = namedtuple('IndexEntry', 'path is_file size modify')
+
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    parent TEXT NOT NULL,
+    name TEXT NOT NULL,
+    is_file INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    modify INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_parent ON entries (parent, is_file);
+CREATE INDEX IF NOT EXISTS entries_size ON entries (size);
+CREATE INDEX IF NOT EXISTS entries_modify ON entries (modify);
+
+-- directories whose entries are current for the modify fact stored for
+-- them in entries
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    listed REAL NOT NULL
+);
+'''
+
+# trigrams of every name, so substrings and globs are looked up instead of
+# scanned for; needs sqlite 3.34 built with fts5. it is kept in step with
+# entries a directory at a time, which is several times faster than triggers.
+_TRIGRAMS = '''
+CREATE VIRTUAL TABLE names USING fts5(
+    name, content='entries', content_rowid='id', tokenize='trigram');
+INSERT INTO names (names) VALUES ('rebuild');
+'''
+
+_WILDCARDS = re.compile(r'[*?\[\]]')
+
+
+def index_path(server_ip, username, server_port=21):
+    directory = os.path.join(os.path.expanduser('~'), '.ftpient')
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    return os.path.join(directory, 'index-%s-%d-%s.sqlite'
+                                   % (server_ip, server_port, username))
+
+
+def _text(path):
+    if isinstance(path, str):
+        return path.decode('utf-8')
+    return path
+
+
+def _subtree(path):
+    # bounds of every path below path; '0' sorts right after '/'
+    prefix = path.rstrip(u'/') + u'/'
+    return prefix, prefix[:-1] + u'0'
+
+
+def _escape_like(text):
+    return text.replace(u'\\', u'\\\\').replace(u'%', u'\\%') \
+               .replace(u'_', u'\\_')
+
+
+class RemoteIndex(object):
+
+    def __init__(self, path=':memory:'):
+        self.path = path
+
+        self._m_db = sqlite3.connect(path, check_same_thread=False)
+        self._m_db.execute('PRAGMA journal_mode=WAL')
+        self._m_db.execute('PRAGMA synchronous=NORMAL')
+        self._m_db.executescript(_SCHEMA)
+        self._m_trigrams = self._create_trigrams()
+        self._m_lock = threading.Lock()
+
+
+    def _create_trigrams(self):
+        if self._m_db.execute("SELECT 1 FROM sqlite_master "
+                              "WHERE name = 'names'").fetchone():
+            return True
+        try:
+            self._m_db.executescript(_TRIGRAMS)
+        except sqlite3.OperationalError:
+            self._m_db.rollback()
+            return False
+        return True
+
+
+    def replace(self, directory, facts):
+        # stores a fresh listing of directory and returns its subdirectories
+        # with whether their own entries are still current
+        directory = _text(directory)
+        prefix = directory.rstrip(u'/') + u'/'
+        rows = []
+        for name, is_file, size, modify in facts:
+            rows.append((prefix + name, directory, name,
+                         int(bool(is_file)), int(size), int(modify)))
+
+        with self._m_lock, self._m_db as db:
+            old = dict(((name, (is_file, modify)) for name, is_file, modify
+                        in db.execute('SELECT name, is_file, modify '
+                                      'FROM entries WHERE parent = ?',
+                                      (directory,))))
+            new = dict((row[2], (row[3], row[5])) for row in rows)
+
+            for name, (is_file, modify) in old.iteritems():
+                if is_file:
+                    continue
+                path = prefix + name
+                if name not in new or new[name][0]:
+                    self._drop(db, path)
+                elif new[name][1] != modify:
+                    # names below it changed, list it again
+                    db.execute('DELETE FROM dirs WHERE path = ?', (path,))
+
+            self._delete(db, 'parent = ?', (directory,))
+            db.executemany('INSERT INTO entries (path, parent, name, is_file, '
+                           'size, modify) VALUES (?, ?, ?, ?, ?, ?)', rows)
+            if self._m_trigrams:
+                db.execute('INSERT INTO names (rowid, name) SELECT id, name '
+                           'FROM entries WHERE parent = ?', (directory,))
+            db.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?)',
+                       (directory, time.time()))
+            return self._subdirs(db, directory)
+
+
+    def _delete(self, db, where, args):
+        if self._m_trigrams:
+            db.execute("INSERT INTO names (names, rowid, name) "
+                       "SELECT 'delete', id, name FROM entries WHERE " + where,
+                       args)
+        db.execute('DELETE FROM entries WHERE ' + where, args)
+
+
+    def _drop(self, db, path):
+        low, high = _subtree(path)
+        self._delete(db, 'path >= ? AND path < ?', (low, high))
+        db.execute('DELETE FROM dirs WHERE path = ? OR '
+                   '(path >= ? AND path < ?)', (path, low, high))
+
+
+    @staticmethod
+    def _subdirs(db, directory):
+        return [(path, modify, bool(current)) for path, modify, current in
+                db.execute('SELECT e.path, e.modify, d.path IS NOT NULL '
+                           'FROM entries e LEFT JOIN dirs d '
+                           'ON d.path = e.path '
+                           'WHERE e.parent = ? AND e.is_file = 0',
+                           (directory,))]
+
+
+    def subdirs(self, directory):
+        # [(path, modify, current)] of the known subdirectories
+        with self._m_lock:
+            return self._subdirs(self._m_db, _text(directory))
+
+
+    def stale(self, directory, modify):
+        # directory has a new modify fact, its entries have to be listed
+        with self._m_lock, self._m_db as db:
+            db.execute('UPDATE entries SET modify = ? WHERE path = ?',
+                       (int(modify), _text(directory)))
+            db.execute('DELETE FROM dirs WHERE path = ?', (_text(directory),))
+
+
+    def search(self, pattern=None, substring=None, min_size=None,
+                     max_size=None, after=None, before=None, under=None,
+                     files_only=False, limit=1000):
+        # pattern is a case sensitive glob on names, substring matches names
+        # ignoring ascii case; after and before are modify facts, such as
+        # 20150101000000
+        clauses, args = [], []
+        # the trigram index only helps with three characters in a row
+        literal = max([len(substring or u'')] +
+                      [len(run) for run in _WILDCARDS.split(pattern or u'')])
+        if self._m_trigrams and literal >= 3:
+            sql = 'SELECT e.path, e.is_file, e.size, e.modify FROM names n ' \
+                  'JOIN entries e ON e.id = n.rowid'
+            name = 'n.name'
+        else:
+            sql = 'SELECT e.path, e.is_file, e.size, e.modify FROM entries e'
+            name = 'e.name'
+
+        if pattern:
+            clauses.append('%s GLOB ?' % name)
+            args.append(_text(pattern))
+        if substring and name == 'n.name':
+            # a phrase of trigrams is the substring, LIKE with an escape
+            # character would not use the index
+            clauses.append('n.name MATCH ?')
+            args.append(u'"%s"' % _text(substring).replace(u'"', u'""'))
+        elif substring:
+            clauses.append("e.name LIKE ? ESCAPE '\\'")
+            args.append(u'%%%s%%' % _escape_like(_text(substring)))
+        if min_size is not None:
+            clauses.append('e.size >= ?')
+            args.append(min_size)
+        if max_size is not None:
+            clauses.append('e.size <= ?')
+            args.append(max_size)
+        if after is not None:
+            clauses.append('e.modify >= ?')
+            args.append(int(after))
+        if before is not None:
+            clauses.append('e.modify < ?')
+            args.append(int(before))
+        if under:
+            clauses.append('e.path >= ? AND e.path < ?')
+            args.extend(_subtree(_text(under)))
+        if files_only:
+            clauses.append('e.is_file = 1')
+
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        # ordering in sql would visit every match before the first row
+        sql += ' LIMIT ?'
+        args.append(limit)
+
+        with self._m_lock:
+            rows = self._m_db.execute(sql, args).fetchall()
+        return sorted(IndexEntry(path, bool(is_file), size, modify)
+                      for path, is_file, size, modify in rows)
+
+
+    def stats(self):
+        with self._m_lock:
+            files, dirs, size = self._m_db.execute(
+                'SELECT SUM(is_file), SUM(1 - is_file), '
+                'SUM(CASE WHEN is_file THEN size ELSE 0 END) '
+                'FROM entries').fetchone()
+            crawled, = self._m_db.execute(
+                'SELECT MAX(listed) FROM dirs').fetchone()
+        return {'files': files or 0, 'dirs': dirs or 0, 'bytes': size or 0,
+                'crawled': crawled}
+
+
+    def clear(self):
+        with self._m_lock, self._m_db as db:
+            if self._m_trigrams:
+                db.execute("INSERT INTO names (names) VALUES ('delete-all')")
+            db.execute('DELETE FROM entries')
+            db.execute('DELETE FROM dirs')
+
+
+    def close(self):
+        with self._m_lock:
+            self._m_db.close()
+
+
+
+class Crawler(object):
+
+    def __init__(self, pool, index, workers=4, callback=lambda _: 1,
+                       token=None):
+        # the crawl logs in sessions of its own with the pool's account, no
+        # more than the pool may hold, and drives them all from one thread
+        self.pool = pool
+        self.index = index
+        self.workers = min(workers, pool.size)
+        # callback(stats) after every directory
+        self.callback = callback
+        # a scheduler's CancelToken, stops the crawl between directories
+        self.token = token
+
+        self._m_logger = logging.getLogger(__name__)
+
+
+    def _connect(self, loop):
+        clients = loop.run_until_complete(gather(
+            *[self.pool.async_session(loop) for _ in xrange(self.workers)]))
+        return [client for client in clients
+                if isinstance(client, AsyncFTPClient)]
+
+
+    def crawl(self, root='/', full=False):
+        # a directory's modify fact changes when names come or go in it, so
+        # only directories with a new one are listed again; the rest are
+        # looked through with MLST on their known subdirectories, which
+        # needs no data connection. files changed in place keep the facts
+        # of the last listing until a full crawl.
+        root = posixpath.normpath(_text(root))
+        stats = {'listed': 0, 'checked': 0, 'entries': 0}
+
+        @coroutine
+        def _list(client, path, queue):
+            success, listing = yield client.list(path)
+            if not success:
+                raise Return(False)
+
+            facts = []
+            for i in xrange(len(listing)):
+                name = listing.name(i)
+                if name in (u'..', u'.'):
+                    continue
+                facts.append((name, listing.is_file(i),
+                              int(listing.sizes[i]), int(listing.mtimes[i])))
+
+            for child, _, current in self.index.replace(path, facts):
+                queue.put((child, full or not current))
+
+            stats['listed'] += 1
+            stats['entries'] += len(facts)
+            raise Return(True)
+
+        @coroutine
+        def _check(client, path, queue):
+            known = self.index.subdirs(path)
+            facts = yield client.mlst([child for child, _, _ in known])
+            for child, modify, current in known:
+                fact = facts[child]
+                if fact is None or fact[1] or fact[3] != modify or \
+                   not current:
+                    if fact is not None and not fact[1]:
+                        self.index.stale(child, fact[3])
+                    queue.put((child, True))
+                else:
+                    queue.put((child, False))
+
+            stats['checked'] += 1
+            raise Return(True)
+
+        @coroutine
+        def _(client, (path, relist), queue):
+            success = yield (_list if relist else _check)(client, path,
+                                                          queue)
+            self.callback(dict(stats))
+            raise Return(success)
+
+        # every session is driven from this thread by one event loop
+        started = time.time()
+        loop = EventLoop()
+        try:
+            clients = self._connect(loop)
+            failed = engine.parallel(loop, clients, [(root, True)], _,
+                                     self._m_logger, name='index',
+                                     token=self.token)
+            loop.run_until_complete(gather(*[client.quit()
+                                             for client in clients
+                                             if client.connected]))
+        finally:
+            loop.close()
+
+        stats['failed'] = [path for path, _ in failed]
+        stats['elapsed'] = time.time() - started
+        if stats['failed']:
+            self._m_logger.error('index: %d directories could not be '
+                                 'indexed, such as %s', len(stats['failed']),
+                                 stats['failed'][0])
+        self._m_logger.info('index: %d listed, %d checked, %d entries in '
+                            '%.1fs', stats['listed'], stats['checked'],
+                            stats['entries'], stats['elapsed'])
+        return stats
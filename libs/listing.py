@@ -0,0 +1,139 @@
+# encoding: utf-8
+from array import array
+
+
+class ListingEntry(object):
+
+    __slots__ = ('_listing', '_index')
+
+    owner = owner_group = attr = subdir_num = u''
+
+
+    def __init__(self, listing, index):
+        self._listing = listing
+        self._index = index
+
+
+    @property
+    def name(self):
+        return self._listing.name(self._index)
+
+
+    @property
+    def is_file(self):
+        return self._listing.is_file(self._index)
+
+
+    def is_dir(self):
+        return not self.is_file
+
+
+    @property
+    def size(self):
+        size = self._listing.sizes[self._index]
+        return unicode(int(size)) if size >= 0 else u''
+
+
+    def _modify(self, start, end):
+        modify = self._listing.mtimes[self._index]
+        return unicode(int(modify))[start:end] if modify else u''
+
+
+    @property
+    def year(self):
+        return self._modify(0, 4)
+
+
+    @property
+    def month(self):
+        return self._modify(4, 6)
+
+
+    @property
+    def day(self):
+        return self._modify(6, 8)
+
+
+    def __repr__(self):
+        return '<ListingEntry %r>' % self.name
+
+
+
+class Listing(object):
+
+    def __init__(self):
+        self._m_names = bytearray()
+        self._m_offsets = array('I', [0])
+        self._m_types = bytearray()
+
+        # doubles hold every integer below 2 ** 53 exactly on every platform,
+        # which 'l' does not on 32-bit longs
+        self.sizes = array('d')
+        self.mtimes = array('d')
+
+        # name -> row, built on the first lookup
+        self._m_index = None
+
+
+    def append(self, name, is_file, size=-1, modify=0):
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+
+        i = len(self.sizes)
+        if not i & 7:
+            self._m_types.append(0)
+        if is_file:
+            self._m_types[i >> 3] |= 1 << (i & 7)
+
+        self._m_names += name
+        self._m_offsets.append(len(self._m_names))
+        self.sizes.append(size)
+        self.mtimes.append(modify)
+        if self._m_index is not None:
+            self._m_index.setdefault(name, i)
+
+
+    def extend(self, facts):
+        for name, is_file, size, modify in facts:
+            self.append(name, is_file, size, modify)
+
+
+    def name(self, i):
+        return self._m_names[self._m_offsets[i]:self._m_offsets[i + 1]] \
+                   .decode('utf-8', 'replace')
+
+
+    def is_file(self, i):
+        return bool(self._m_types[i >> 3] >> (i & 7) & 1)
+
+
+    def find(self, name):
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+
+        if self._m_index is None:
+            names, offsets, index = self._m_names, self._m_offsets, {}
+            for i in xrange(len(self) - 1, -1, -1):
+                index[str(names[offsets[i]:offsets[i + 1]])] = i
+            self._m_index = index
+        return self._m_index.get(name)
+
+
+    def __len__(self):
+        return len(self.sizes)
+
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [ListingEntry(self, j)
+                    for j in xrange(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return ListingEntry(self, i)
+
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield ListingEntry(self, i)
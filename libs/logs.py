@@ -0,0 +1,129 @@
+# encoding: utf-8
+import sys
+import logging
+import threading
+from collections import deque
+
+
+FORMAT = '%(asctime)s %(name)s %(levelname)s %(message)s'
+
+
+class QueueHandler(logging.Handler):
+
+    def __init__(self, capacity=100000):
+        super(QueueHandler, self).__init__()
+        # deque.append is atomic, so producers never wait on a lock; when the
+        # sink falls behind the oldest records are dropped
+        self.queue = deque(maxlen=capacity)
+
+
+    def handle(self, record):
+        rv = self.filter(record)
+        if rv:
+            self.queue.append(record)
+        return rv
+
+
+    def emit(self, record):
+        self.queue.append(record)
+
+
+
+class LineBuffer(object):
+
+    def __init__(self, capacity=5000):
+        self._m_lines = deque(maxlen=capacity)
+
+
+    def extend(self, lines):
+        self._m_lines.extend(lines)
+
+
+    def drain(self):
+        lines = []
+        try:
+            while True:
+                lines.append(self._m_lines.popleft())
+        except IndexError:
+            pass
+        return lines
+
+
+
+class LogPipeline(object):
+
+    def __init__(self, interval=0.2, capacity=100000, fmt=FORMAT):
+        self.interval = interval
+        self.handler = QueueHandler(capacity)
+        self.formatter = logging.Formatter(fmt)
+
+        self._m_sinks = []
+        self._m_stop = threading.Event()
+        self._m_thread = None
+
+
+    def add_sink(self, sink):
+        # sink(lines) is called from the pipeline thread with each batch
+        self._m_sinks.append(sink)
+
+
+    def remove_sink(self, sink):
+        if sink in self._m_sinks:
+            self._m_sinks.remove(sink)
+
+
+    def flush(self):
+        queue, lines = self.handler.queue, []
+        try:
+            while True:
+                lines.append(self.formatter.format(queue.popleft()))
+        except IndexError:
+            pass
+
+        if lines:
+            for sink in list(self._m_sinks):
+                sink(lines)
+
+
+    def _run(self):
+        while not self._m_stop.wait(self.interval):
+            self.flush()
+        self.flush()
+
+
+    def start(self):
+        if self._m_thread is None:
+            self._m_thread = threading.Thread(target=self._run)
+            self._m_thread.daemon = True
+            self._m_thread.start()
+        return self
+
+
+    def stop(self):
+        self._m_stop.set()
+        if self._m_thread is not None:
+            self._m_thread.join()
+            self._m_thread = None
+        self._m_stop.clear()
+
+
+
+def stream_sink(stream=sys.stderr):
+    def sink(lines):
+        stream.write('\n'.join(lines) + '\n')
+        stream.flush()
+    return sink
+
+
+pipeline = LogPipeline()
+
+
+def setup(level=logging.INFO, logger='libs', stream=sys.stderr):
+    log = logging.getLogger(logger)
+    log.setLevel(level)
+    if pipeline.handler not in log.handlers:
+        log.addHandler(pipeline.handler)
+        log.propagate = False
+    if stream is not None:
+        pipeline.add_sink(stream_sink(stream))
+    return pipeline.start()
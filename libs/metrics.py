@@ -0,0 +1,174 @@
+# encoding: utf-8
+import json
+import bisect
+import threading
+
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# 64KB/s to 4GB/s
+THROUGHPUT_BUCKETS = tuple(float(64 * 1024 * 4 ** i) for i in range(9))
+SIZE_BUCKETS = (10, 100, 1000, 10000, 100000, 1000000)
+
+
+class _Metric(object):
+
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+        self._m_values = {}
+        self._m_lock = threading.Lock()
+
+
+    def _key(self, label_values):
+        if len(label_values) != len(self.labels):
+            raise ValueError('%s expects labels %s, got %r'
+                             % (self.name, self.labels, label_values))
+        return tuple(label_values)
+
+
+    def _label_text(self, key, extra=()):
+        pairs = zip(self.labels, key) + list(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('"', '\\"'))
+                                 for k, v in pairs)
+
+
+
+class Counter(_Metric):
+
+    kind = 'counter'
+
+    def inc(self, amount=1, *label_values):
+        key = self._key(label_values)
+        with self._m_lock:
+            self._m_values[key] = self._m_values.get(key, 0) + amount
+
+
+    def snapshot(self):
+        with self._m_lock:
+            return [{'labels': dict(zip(self.labels, key)), 'value': value}
+                    for key, value in sorted(self._m_values.items())]
+
+
+    def prometheus(self):
+        with self._m_lock:
+            return ['%s%s %s' % (self.name, self._label_text(key), value)
+                    for key, value in sorted(self._m_values.items())]
+
+
+
+class Histogram(_Metric):
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+
+    def observe(self, value, *label_values):
+        key = self._key(label_values)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._m_lock:
+            counts = self._m_values.get(key)
+            if counts is None:
+                # one slot per bucket plus +Inf, then sum
+                counts = self._m_values[key] = [0] * (len(self.buckets) + 1) \
+                                               + [0.0]
+            counts[i] += 1
+            counts[-1] += value
+
+
+    def snapshot(self):
+        ret = []
+        with self._m_lock:
+            for key, counts in sorted(self._m_values.items()):
+                cumulative, buckets = 0, {}
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    buckets[str(bound)] = cumulative
+                ret.append({'labels': dict(zip(self.labels, key)),
+                            'buckets': buckets,
+                            'count': cumulative,
+                            'sum': counts[-1]})
+        return ret
+
+
+    def prometheus(self):
+        lines = []
+        with self._m_lock:
+            for key, counts in sorted(self._m_values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append('%s_bucket%s %d' % (
+                        self.name, self._label_text(key, [('le', bound)]),
+                        cumulative))
+                lines.append('%s_sum%s %s' % (self.name,
+                                              self._label_text(key),
+                                              counts[-1]))
+                lines.append('%s_count%s %d' % (self.name,
+                                                self._label_text(key),
+                                                cumulative))
+        return lines
+
+
+
+class Registry(object):
+
+    def __init__(self):
+        self._m_metrics = {}
+        self._m_lock = threading.Lock()
+
+
+    def _get(self, cls, name, help, labels, **kwargs):
+        with self._m_lock:
+            metric = self._m_metrics.get(name)
+            if metric is None:
+                metric = self._m_metrics[name] = cls(name, help, labels,
+                                                     **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError('%s is already a %s' % (name, metric.kind))
+            return metric
+
+
+    def counter(self, name, help, labels=()):
+        return self._get(Counter, name, help, labels)
+
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._get(Histogram, name, help, labels, buckets=buckets)
+
+
+    def _sorted(self):
+        with self._m_lock:
+            return sorted(self._m_metrics.values(), key=lambda m: m.name)
+
+
+    def snapshot(self):
+        return dict((metric.name, {'type': metric.kind, 'help': metric.help,
+                                   'values': metric.snapshot()})
+                    for metric in self._sorted())
+
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.snapshot(), **kwargs)
+
+
+    def to_prometheus(self):
+        lines = []
+        for metric in self._sorted():
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            lines.extend(metric.prometheus())
+        return '\n'.join(lines) + '\n'
+
+
+
+registry = Registry()
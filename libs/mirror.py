@@ -0,0 +1,280 @@
+# encoding: utf-8
+import os
+import time
+import socket
+import logging
+import calendar
+import posixpath
+import threading
+from Queue import Queue
+
+from libs.progress import ProgressReporter
+
+
+def modify_to_epoch(modify):
+    if not modify:
+        return 0
+    return calendar.timegm(time.strptime('%014d' % modify, '%Y%m%d%H%M%S'))
+
+
+def epoch_to_modify(epoch):
+    return time.strftime('%Y%m%d%H%M%S', time.gmtime(epoch))
+
+
+def parallel(pool, workers, items, handle, logger, name='mirror',
+             token=None):
+    # handle(client, item, queue) runs on a pooled session per item and may
+    # queue more items; the items it fails on are returned. once token is
+    # cancelled the items still queued are failed without being handled.
+    queue = Queue()
+    for item in items:
+        queue.put(item)
+    failed = []
+
+    def run(client, item):
+        if token is None:
+            return handle(client, item, queue)
+        # a cancel stops what the session is transferring right now
+        token.attach(client)
+        try:
+            return handle(client, item, queue)
+        finally:
+            token.detach(client)
+
+    def work():
+        while True:
+            item = queue.get()
+            if item is None:
+                queue.task_done()
+                return
+            if token is not None and token.cancelled:
+                failed.append(item)
+                queue.task_done()
+                continue
+            try:
+                with pool.session() as client:
+                    if client is None or not run(client, item):
+                        failed.append(item)
+            except socket.error as e:
+                logger.error('%s: %s failed, %s', name, item, e)
+                failed.append(item)
+            except Exception:
+                # local trouble with one item, the queue still has to drain
+                logger.error('%s: %s failed', name, item, exc_info=True)
+                failed.append(item)
+            finally:
+                queue.task_done()
+
+    threads = [threading.Thread(target=work) for _ in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    queue.join()
+    for _ in threads:
+        queue.put(None)
+    for thread in threads:
+        thread.join()
+
+    return failed
+
+
+
+class Mirror(object):
+
+    def __init__(self, pool, workers=4, callback=lambda _: 1, token=None):
+        self.pool = pool
+        self.workers = min(workers, pool.size)
+        self.callback = callback
+        # a scheduler's CancelToken, stops the mirror between files
+        self.token = token
+
+        self._m_logger = logging.getLogger(__name__)
+        self._m_lock = threading.Lock()
+
+
+    @staticmethod
+    def _unchanged(source_size, source_mtime, target_size, target_mtime):
+        return source_size == target_size and target_mtime >= source_mtime
+
+
+    def _absolute(self, remote_dir):
+        # every path of the walk is joined to remote_dir and may run on any
+        # pooled session, so a relative one is resolved once, against the
+        # directory sessions log in to
+        if remote_dir.startswith('/'):
+            return posixpath.normpath(remote_dir)
+        with self.pool.session() as client:
+            if client is None or client.home is None:
+                return remote_dir
+            return posixpath.normpath(posixpath.join(client.home, remote_dir))
+
+
+    def _parallel(self, items, handle):
+        return parallel(self.pool, self.workers, items, handle, self._m_logger,
+                        token=self.token)
+
+
+    def _walk_remote(self, remote_dir):
+        files, dirs = [], [remote_dir]
+
+        def _(client, directory, queue):
+            success, listing = client.list(directory, refresh=True)
+            if not success:
+                return False
+
+            for i in xrange(len(listing)):
+                name = listing.name(i)
+                if name in (u'..', u'.'):
+                    continue
+                path = posixpath.join(directory, name)
+                if listing.is_file(i):
+                    with self._m_lock:
+                        files.append((path, int(listing.sizes[i]),
+                                      modify_to_epoch(int(listing.mtimes[i]))))
+                else:
+                    with self._m_lock:
+                        dirs.append(path)
+                    queue.put(path)
+            return True
+
+        failed = self._parallel([remote_dir], _)
+        return dirs, files, failed
+
+
+    def _transfer(self, plan, method):
+        total = sum(size for _, _, size, _ in plan)
+        done, wire = [0], [0]
+        progress = ProgressReporter(self.callback)
+
+        def _(client, (source, target, size, mtime), queue):
+            sent = [0]
+
+            def _progress(_, now):
+                with self._m_lock:
+                    done[0] += now - sent[0]
+                    sent[0] = now
+                    current = done[0]
+                progress(total, current)
+
+            success = method(client, source, target, size, mtime, _progress)
+            last = client.last_transfer
+            if success and last is not None:
+                with self._m_lock:
+                    wire[0] += last['wire_bytes']
+            return success
+
+        started = time.time()
+        failed = self._parallel(plan, _)
+        progress.finish()
+
+        elapsed = time.time() - started
+        return {'transferred': len(plan) - len(failed),
+                'failed': [source for source, _, _, _ in failed],
+                'bytes': done[0],
+                'wire_bytes': wire[0],
+                'compression_ratio': float(wire[0]) / done[0] if done[0]
+                                     else 1.0,
+                'elapsed': elapsed,
+                'rate': done[0] / elapsed if elapsed > 0 else 0.0}
+
+
+    @staticmethod
+    def _makedirs(client, directory):
+        path = ''
+        for part in directory.strip('/').split('/'):
+            path += '/' + part
+            client.mkd(path)
+
+
+    @staticmethod
+    def _fetch(client, remote, local, size, mtime, callback):
+        if not client.download(remote, local, callback=callback):
+            return False
+        if mtime:
+            os.utime(local, (mtime, mtime))
+        return True
+
+
+    @staticmethod
+    def _store(client, local, remote, size, mtime, callback):
+        if not client.upload(remote, local, callback=callback):
+            return False
+        client.mfmt(posixpath.basename(remote), epoch_to_modify(mtime))
+        return True
+
+
+    def download(self, remote_dir, local_dir):
+        remote_dir = self._absolute(remote_dir)
+        dirs, files, failed = self._walk_remote(remote_dir)
+
+        for directory in dirs:
+            target = os.path.join(local_dir,
+                                  posixpath.relpath(directory, remote_dir))
+            if not os.path.isdir(target):
+                os.makedirs(target)
+
+        plan, skipped = [], 0
+        for remote, size, mtime in files:
+            local = os.path.join(local_dir, posixpath.relpath(remote,
+                                                              remote_dir))
+            if os.path.isfile(local):
+                stat = os.stat(local)
+                if self._unchanged(size, mtime, stat.st_size, stat.st_mtime):
+                    skipped += 1
+                    continue
+            plan.append((remote, local, size, mtime))
+
+        ret = self._transfer(plan, self._fetch)
+        ret['skipped'] = skipped
+        ret['failed'] += failed
+        return ret
+
+
+    def upload(self, local_dir, remote_dir):
+        remote_dir = self._absolute(remote_dir)
+        dirs, files = [], []
+        for root, _, filenames in os.walk(local_dir):
+            relative = os.path.relpath(root, local_dir)
+            remote_root = posixpath.normpath(
+                posixpath.join(remote_dir, relative.replace(os.sep, '/')))
+            dirs.append(remote_root)
+            for filename in filenames:
+                local = os.path.join(root, filename)
+                stat = os.stat(local)
+                files.append((local, posixpath.join(remote_root, filename),
+                              stat.st_size, int(stat.st_mtime)))
+
+        existing = {}
+
+        def _(client, directory, queue):
+            success, listing = client.list(directory, refresh=True)
+            if not success:
+                self._makedirs(client, directory)
+                if not client.cwd(directory):
+                    return False
+            for i in xrange(len(listing)):
+                if listing.is_file(i):
+                    existing[posixpath.join(directory, listing.name(i))] = \
+                        (int(listing.sizes[i]),
+                         modify_to_epoch(int(listing.mtimes[i])))
+            return True
+
+        # parents are created before children since os.walk is top-down
+        failed = []
+        for depth in sorted(set(d.count('/') for d in dirs)):
+            failed += self._parallel([d for d in dirs
+                                      if d.count('/') == depth], _)
+
+        plan, skipped = [], 0
+        for local, remote, size, mtime in files:
+            if remote in existing and \
+               self._unchanged(size, mtime, *existing[remote]):
+                skipped += 1
+                continue
+            plan.append((local, remote, size, mtime))
+
+        ret = self._transfer(plan, self._store)
+        ret['skipped'] = skipped
+        ret['failed'] += failed
+        return ret
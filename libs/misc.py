@@ -1,9 +1,10 @@
 # encoding: utf-8
-from logging import Handler
-from PySide.QtCore import *
 
 
 class DirEntry(object):
+    __slots__ = ('attr', 'subdir_num', 'owner', 'owner_group', 'size',
+                 'month', 'day', 'year', 'name', 'is_file')
+
     def __init__(self,
                  attr='',
                  subdir_num='',
@@ -27,15 +28,3 @@ class DirEntry(object):
     def is_dir(self):
         return not self.is_file
 
-
-
-class LoggerHandler(Handler):
-    def __init__(self, logger_widget):
-        self.logger_widget = logger_widget
-        super(LoggerHandler, self).__init__()
-
-
-    def emit(self, record):
-        self.logger_widget.emit(SIGNAL('new_log(QString)'), self.format(record))
-
-
@@ -0,0 +1,66 @@
+# encoding: utf-8
+from libs.misc import DirEntry
+
+
+def parse_facts(line):
+    facts, _, name = line.partition(' ')
+    if not name:
+        return None
+
+    type_ = size = modify = ''
+    for fact in facts.split(';'):
+        key, _, value = fact.partition('=')
+        key = key.lower()
+        if key == 'type':
+            type_ = value.lower()
+        elif key == 'size':
+            size = value
+        elif key == 'modify':
+            modify = value[:14]
+
+    # the listed directory itself and its parent; the caller adds '..'
+    if type_ in ('cdir', 'pdir'):
+        return None
+
+    is_file = type_ == 'file'
+    return (name, is_file,
+            int(size) if is_file and size.isdigit() else -1,
+            int(modify) if modify.isdigit() else 0)
+
+
+def _to_entry(facts):
+    name, is_file, size, modify = facts
+    modify = str(modify) if modify else ''
+    return DirEntry(year=modify[0:4], month=modify[4:6], day=modify[6:8],
+                    hour=modify[8:10], minute=modify[10:12],
+                    second=modify[12:14],
+                    name=name, is_file=is_file,
+                    size=str(size) if size >= 0 else '')
+
+
+def parse_line(line):
+    facts = parse_facts(line)
+    if facts is None:
+        return None
+    return _to_entry(facts)
+
+
+def iter_facts(chunks):
+    tail = ''
+    for chunk in chunks:
+        lines = (tail + chunk).split('\n')
+        tail = lines.pop()
+        for line in lines:
+            facts = parse_facts(line.rstrip('\r'))
+            if facts is not None:
+                yield facts
+
+    if tail:
+        facts = parse_facts(tail.rstrip('\r'))
+        if facts is not None:
+            yield facts
+
+
+def parse(chunks):
+    for facts in iter_facts(chunks):
+        yield _to_entry(facts)
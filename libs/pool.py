@@ -0,0 +1,199 @@
+# encoding: utf-8
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+from libs.ftp import FTPClient
+from libs.engine import AsyncFTPClient, Return, coroutine
+
+
+class SessionPool(object):
+
+    def __init__(self, server_ip, username, password, server_port=21,
+                       size=4, idle_timeout=60, check_interval=5,
+                       timeout=10, listing_cache=None, content_cache=None):
+        self._c_server_ip = server_ip
+        self._c_server_port = server_port
+        self._c_username = username
+        self._c_password = password
+        self._c_idle_timeout = idle_timeout
+        self._c_check_interval = check_interval
+        # seconds a health check, reset or goodbye may take; a connection
+        # dropped without a FIN would otherwise hang acquire() for good
+        self._c_timeout = timeout
+
+        self.size = size
+        self.listing_cache = listing_cache
+        self.content_cache = content_cache
+
+        self._m_idle = []
+        self._m_busy = set()
+        self._m_lock = threading.Lock()
+        self._m_available = threading.Semaphore(size)
+
+
+    def _new_session(self):
+        client = FTPClient(self._c_server_ip, self._c_server_port)
+        client.listing_cache = self.listing_cache
+        client.content_cache = self.content_cache
+        try:
+            client._m_cmd_sock.settimeout(self._c_timeout)
+            client.connect()
+            if client.login(self._c_username, self._c_password):
+                client._m_cmd_sock.settimeout(None)
+                return client
+        except socket.error as e:
+            client._m_logger.error('pool: cannot connect to %s, %s',
+                                   self._c_server_ip, e)
+        self._discard(client)
+        return None
+
+
+    def _discard(self, client):
+        try:
+            if client.connected:
+                client._m_cmd_sock.settimeout(self._c_timeout)
+                client.quit()
+        except socket.error:
+            pass
+        client._m_cmd_sock.close()
+        client.connected = False
+
+
+    def _bounded(self, client, check):
+        client._m_cmd_sock.settimeout(self._c_timeout)
+        try:
+            return check()
+        except socket.error:
+            return False
+        finally:
+            client._m_cmd_sock.settimeout(None)
+
+
+    def _healthy(self, client):
+        return self._bounded(client, client.noop)
+
+
+    def _reset(self, client):
+        # the last user may have left the session anywhere; relative paths
+        # of the next one start from the login directory again
+        if client.home is None or client._m_cwd == client.home:
+            return True
+        return self._bounded(client, lambda: client.cwd(client.home))
+
+
+    @coroutine
+    def async_session(self, loop):
+        # a logged in session on loop for work the event engine drives,
+        # such as a crawl; it is not pooled, the caller quits it
+        client = AsyncFTPClient(loop, self._c_server_ip, self._c_server_port,
+                                timeout=self._c_timeout)
+        try:
+            if (yield client.connect()) and \
+               (yield client.login(self._c_username, self._c_password)):
+                raise Return(client)
+        except socket.error as e:
+            client._m_logger.error('pool: cannot connect to %s, %s',
+                                   self._c_server_ip, e)
+        if client.connected:
+            client._m_control.close()
+        raise Return(None)
+
+
+    def evict_idle(self):
+        now = time.time()
+        with self._m_lock:
+            expired = [c for c, t in self._m_idle
+                       if now - t > self._c_idle_timeout]
+            self._m_idle = [(c, t) for c, t in self._m_idle
+                            if now - t <= self._c_idle_timeout]
+
+        for client in expired:
+            self._discard(client)
+
+
+    def acquire(self):
+        self._m_available.acquire()
+        self.evict_idle()
+
+        client = None
+        while True:
+            with self._m_lock:
+                if not self._m_idle:
+                    break
+                client, last_used = self._m_idle.pop()
+
+            if (time.time() - last_used < self._c_check_interval or
+                self._healthy(client)) and self._reset(client):
+                break
+            self._discard(client)
+            client = None
+
+        if client is None:
+            client = self._new_session()
+            if client is None:
+                self._m_available.release()
+                return None
+
+        with self._m_lock:
+            self._m_busy.add(client)
+        return client
+
+
+    def release(self, client, reusable=True):
+        with self._m_lock:
+            self._m_busy.discard(client)
+
+        client.stop = False
+        if reusable and client.connected:
+            with self._m_lock:
+                self._m_idle.append((client, time.time()))
+        else:
+            self._discard(client)
+
+        self._m_available.release()
+
+
+    @contextmanager
+    def session(self):
+        client = self.acquire()
+        reusable = False
+        try:
+            yield client
+            reusable = True
+        finally:
+            if client is not None:
+                self.release(client, reusable=reusable)
+
+
+    def stop(self):
+        with self._m_lock:
+            for client in self._m_busy:
+                client.stop = True
+
+
+    def close(self):
+        with self._m_lock:
+            idle, self._m_idle = self._m_idle, []
+
+        for client, _ in idle:
+            self._discard(client)
+
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(server_ip, username, password, server_port=21, **kwargs):
+    key = (server_ip, server_port, username)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None or pool._c_password != password:
+            if pool is not None:
+                pool.close()
+            pool = _pools[key] = SessionPool(server_ip, username, password,
+                                             server_port=server_port,
+                                             **kwargs)
+        return pool
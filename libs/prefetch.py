@@ -0,0 +1,114 @@
+# encoding: utf-8
+import posixpath
+import threading
+from collections import OrderedDict, deque
+
+from libs.scheduler import Scheduler
+
+
+class Prefetcher(object):
+
+    # entries looked at when picking subdirectories of a huge listing
+    SCAN_LIMIT = 10000
+
+    def __init__(self, scheduler, listing_cache, budget=4, concurrency=1,
+                       history=64):
+        self.scheduler = scheduler
+        self.listing_cache = listing_cache
+        # listings planned ahead per navigation step
+        self.budget = budget
+        # sessions taken at once, the rest of the pool stays free for the user
+        self.concurrency = concurrency
+
+        self._m_history = OrderedDict()
+        self._m_history_size = history
+        self._m_planned = deque()
+        self._m_running = {}
+        self._m_lock = threading.Lock()
+
+
+    def _pump(self):
+        with self._m_lock:
+            while self._m_planned and \
+                  len(self._m_running) < self.concurrency:
+                path = self._m_planned.popleft()
+                if path in self._m_running or \
+                   self.listing_cache.get(path) is not None:
+                    continue
+                self._m_running[path] = self._submit(path)
+
+
+    def _submit(self, path):
+        def _(client):
+            return client.list(path)[0]
+
+        def done(_):
+            with self._m_lock:
+                self._m_running.pop(path, None)
+            self._pump()
+
+        return self.scheduler.submit(_, priority=Scheduler.PREFETCH,
+                                     callback=done, retries=0,
+                                     name=u'prefetch %s' % path)
+
+
+    def _candidates(self, path, entries):
+        with self._m_lock:
+            history = list(reversed(self._m_history))
+
+        # children visited before, most recent first, then the parent, then
+        # the first subdirectories as listed
+        candidates = []
+        for visited in history:
+            if posixpath.dirname(visited) == path:
+                i = entries.find(posixpath.basename(visited))
+                if i is not None and not entries.is_file(i):
+                    candidates.append(visited)
+        if path != '/':
+            candidates.append(posixpath.dirname(path))
+
+        for i in xrange(min(len(entries), self.SCAN_LIMIT)):
+            if len(candidates) >= self.budget:
+                break
+            if entries.is_file(i):
+                continue
+            name = entries.name(i)
+            child = posixpath.join(path, name)
+            if name not in (u'..', u'.') and child not in candidates:
+                candidates.append(child)
+        return candidates[:self.budget]
+
+
+    def visited(self, path, entries):
+        path = posixpath.normpath(path)
+        with self._m_lock:
+            self._m_history.pop(path, None)
+            self._m_history[path] = True
+            while len(self._m_history) > self._m_history_size:
+                self._m_history.popitem(last=False)
+
+        # guesses made for the previous directory are dropped; a listing
+        # already running finishes into the cache anyway
+        candidates = self._candidates(path, entries)
+        with self._m_lock:
+            self._m_planned = deque(candidates)
+        self._pump()
+
+
+    def hint(self, path):
+        path = posixpath.normpath(path)
+        with self._m_lock:
+            if path in self._m_planned:
+                self._m_planned.remove(path)
+            self._m_planned.appendleft(path)
+            while len(self._m_planned) > self.budget:
+                self._m_planned.pop()
+        self._pump()
+
+
+    def cancel(self):
+        with self._m_lock:
+            self._m_planned.clear()
+            running = self._m_running.values()
+        for token in running:
+            token.cancel()
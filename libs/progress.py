@@ -0,0 +1,61 @@
+# encoding: utf-8
+import time
+import threading
+from collections import namedtuple
+
+
+Progress = namedtuple('Progress', 'total now rate eta elapsed')
+
+
+class ProgressReporter(object):
+
+    def __init__(self, callback, max_rate=20, smoothing=0.3):
+        self._c_interval = 1.0 / max_rate
+        self._c_smoothing = smoothing
+
+        self.callback = callback
+
+        self._m_lock = threading.Lock()
+        self._m_start = time.time()
+        self._m_last_time = self._m_start
+        self._m_last_now = 0
+        self._m_total = 0
+        self._m_now = 0
+
+        self.rate = 0.0
+
+
+    def __call__(self, total, now):
+        self._m_total, self._m_now = total, now
+
+        if time.time() - self._m_last_time < self._c_interval and now < total:
+            return
+        # whoever is already reporting wins; the others just go on receiving
+        if self._m_lock.acquire(False):
+            try:
+                self._report()
+            finally:
+                self._m_lock.release()
+
+
+    def _report(self):
+        t = time.time()
+        total, now = self._m_total, self._m_now
+
+        elapsed = t - self._m_last_time
+        if elapsed > 0 and now != self._m_last_now:
+            rate = (now - self._m_last_now) / elapsed
+            if self.rate:
+                rate = self._c_smoothing * rate + \
+                       (1 - self._c_smoothing) * self.rate
+            self.rate = rate
+        self._m_last_time, self._m_last_now = t, now
+
+        eta = (total - now) / self.rate if self.rate > 0 else None
+        self.callback(Progress(total, now, self.rate, eta,
+                               t - self._m_start))
+
+
+    def finish(self):
+        with self._m_lock:
+            self._report()
@@ -0,0 +1,214 @@
+# encoding: utf-8
+import heapq
+import itertools
+import logging
+import socket
+import threading
+import time
+
+
+class CancelToken(object):
+
+    def __init__(self):
+        self.cancelled = False
+
+        # sessions working for the job, several for a mirror
+        self._m_clients = set()
+        self._m_lock = threading.Lock()
+
+
+    def cancel(self):
+        with self._m_lock:
+            self.cancelled = True
+            for client in self._m_clients:
+                client.stop = True
+
+
+    def attach(self, client):
+        with self._m_lock:
+            self._m_clients.add(client)
+            if self.cancelled:
+                client.stop = True
+
+
+    def detach(self, client):
+        with self._m_lock:
+            self._m_clients.discard(client)
+
+
+
+class Job(object):
+
+    def __init__(self, function, priority, callback, retries, name,
+                       session):
+        self.function = function
+        self.priority = priority
+        self.callback = callback
+        self.retries = retries
+        self.name = name
+        self.session = session
+
+        self.token = CancelToken()
+        self.attempts = 0
+
+
+
+class Scheduler(object):
+
+    # lower runs first
+    LISTING = 0
+    TRANSFER = 10
+    BULK = 20
+    PREFETCH = 30
+
+    def __init__(self, pool, workers=None, retries=2, backoff=1.0,
+                       max_backoff=30.0):
+        self.pool = pool
+        self.workers = workers or pool.size
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self._m_logger = logging.getLogger(__name__)
+        self._m_ready = []
+        self._m_delayed = []
+        self._m_jobs = set()
+        self._m_seq = itertools.count()
+        self._m_cond = threading.Condition()
+        self._m_threads = []
+        self._m_shutdown = False
+
+
+    def submit(self, function, priority=TRANSFER, callback=lambda _: 1,
+               retries=None, name=None, session=True):
+        # function(client) runs on a pooled session; without one it is
+        # function(token), for jobs such as a mirror that take sessions of
+        # their own and check the token between items
+        job = Job(function, priority, callback,
+                  self.retries if retries is None else retries,
+                  name or getattr(function, '__name__', 'job'), session)
+
+        with self._m_cond:
+            if self._m_shutdown:
+                raise RuntimeError('scheduler is shut down')
+            self._m_jobs.add(job)
+            heapq.heappush(self._m_ready,
+                           (priority, next(self._m_seq), job))
+            if len(self._m_threads) < self.workers:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._m_threads.append(thread)
+            self._m_cond.notify()
+
+        return job.token
+
+
+    def _next(self):
+        with self._m_cond:
+            while True:
+                now = time.time()
+                while self._m_delayed and self._m_delayed[0][0] <= now:
+                    _, _, job = heapq.heappop(self._m_delayed)
+                    heapq.heappush(self._m_ready,
+                                   (job.priority, next(self._m_seq), job))
+
+                if self._m_ready:
+                    return heapq.heappop(self._m_ready)[2]
+                if self._m_shutdown:
+                    return None
+
+                timeout = None
+                if self._m_delayed:
+                    timeout = self._m_delayed[0][0] - now
+                self._m_cond.wait(timeout)
+
+
+    def _run(self, job):
+        if not job.session:
+            return job.function(job.token)
+
+        success = False
+        with self.pool.session() as client:
+            if client is not None:
+                job.token.attach(client)
+                try:
+                    success = job.function(client)
+                finally:
+                    job.token.detach(client)
+        return success
+
+
+    def _work(self):
+        while True:
+            job = self._next()
+            if job is None:
+                return
+
+            success = False
+            if not job.token.cancelled:
+                job.attempts += 1
+                try:
+                    success = self._run(job)
+                except socket.error as e:
+                    self._m_logger.error('%s: %s', job.name, e)
+                except Exception:
+                    # a local failure, such as an unwritable target, is a
+                    # failed attempt; the worker has to outlive it
+                    self._m_logger.error('%s: failed', job.name, exc_info=True)
+
+            if not success and not job.token.cancelled \
+               and job.attempts <= job.retries:
+                delay = min(self.backoff * 2 ** (job.attempts - 1),
+                            self.max_backoff)
+                self._m_logger.warning('%s: attempt %d failed, retrying in '
+                                       '%.1fs', job.name, job.attempts, delay)
+                with self._m_cond:
+                    heapq.heappush(self._m_delayed,
+                                   (time.time() + delay, next(self._m_seq),
+                                    job))
+                    self._m_cond.notify()
+                continue
+
+            with self._m_cond:
+                self._m_jobs.discard(job)
+            try:
+                job.callback(bool(success))
+            except Exception:
+                self._m_logger.error('%s: callback failed', job.name,
+                                     exc_info=True)
+
+
+    def _flush_delayed(self):
+        for _, _, job in self._m_delayed:
+            heapq.heappush(self._m_ready,
+                           (job.priority, next(self._m_seq), job))
+        self._m_delayed = []
+        self._m_cond.notify_all()
+
+
+    def cancel_all(self):
+        with self._m_cond:
+            jobs = list(self._m_jobs)
+        for job in jobs:
+            job.token.cancel()
+
+        # cancelled retries are reported right away instead of after backoff
+        with self._m_cond:
+            self._flush_delayed()
+
+
+    def pending(self):
+        with self._m_cond:
+            return len(self._m_jobs)
+
+
+    def shutdown(self, cancel=True):
+        if cancel:
+            self.cancel_all()
+        with self._m_cond:
+            self._m_shutdown = True
+            self._flush_delayed()
+            threads, self._m_threads = self._m_threads, []
+        for thread in threads:
+            thread.join()
@@ -0,0 +1,151 @@
+# encoding: utf-8
+import os
+import posixpath
+import threading
+
+from libs.writer import preallocate
+
+
+class SegmentedDownload(object):
+
+    MIN_SEGMENT_SIZE = 1024 * 1024
+
+
+    def __init__(self, client, segments=4, pool=None):
+        # without a client the file is looked at on a pooled session
+        self.client = client
+        self.segments = segments
+        self.pool = pool
+
+        self._m_lock = threading.Lock()
+
+
+    def split(self, size):
+        count = max(1, min(self.segments, size // self.MIN_SEGMENT_SIZE))
+        length = size // count
+
+        ranges = []
+        for i in range(count):
+            offset = i * length
+            if i == count - 1:
+                length = size - offset
+            ranges.append((offset, length))
+        return ranges
+
+
+    def _fetch(self, directory, filename, target_path, offset, length,
+               passive, progress, results, i):
+        if self.pool is not None:
+            worker = self.pool.acquire()
+        else:
+            worker = self.client.clone()
+        if worker is None:
+            return
+
+        def _(_, now):
+            if self.client is not None and self.client.stop:
+                worker.stop = True
+            with self._m_lock:
+                progress[i] = now
+                done = sum(progress)
+            self._m_callback(self._m_size, done)
+
+        try:
+            if not worker.cwd(directory):
+                return
+            if passive:
+                worker.passive_mode()
+            else:
+                worker.port_mode()
+            results[i] = worker.retrieve_range(filename, target_path,
+                                               offset, length,
+                                               callback=_, passive=passive)
+        finally:
+            if self.pool is None:
+                worker.quit()
+            else:
+                # a range that stops short of the end of the file was aborted
+                # and may leave a stray reply behind, so only keep full reads
+                full = offset + length == self._m_size
+                self.pool.release(worker, reusable=results[i] and full)
+
+
+    def _probe(self, client, path):
+        # (directory in full, file name, size) of path, directory is None
+        # when the session does not know where it is
+        directory, filename = posixpath.split(path)
+
+        if not filename:
+            client._m_logger.error('%s is not a valid path', path)
+            return None
+
+        if not client.cwd(directory or '.'):
+            return None
+        _, size = client.size(filename)
+        if not size:
+            return None
+        # the workers start from their own home, not from where this
+        # session is, so they are given the directory in full
+        return client._m_cwd, filename, size
+
+
+    def download(self, path, target_path, passive=True,
+                 callback=lambda _1, _2: 1):
+        if self.client is not None:
+            probed = self._probe(self.client, path)
+            if probed is None:
+                return False
+            directory, filename, size = probed
+            if directory is None or len(self.split(size)) == 1:
+                # this session is in the directory already
+                return self.client.download(filename, target_path,
+                                            passive=passive,
+                                            callback=callback)
+        else:
+            # the session looking at the file goes back before the ranges
+            # take theirs, so a pool of one session never waits on itself
+            with self.pool.session() as client:
+                if client is None:
+                    return False
+                probed = self._probe(client, path)
+                if probed is None:
+                    return False
+                directory, filename, size = probed
+                if directory is None or len(self.split(size)) == 1:
+                    return client.download(filename, target_path,
+                                           passive=passive,
+                                           callback=callback)
+
+        ranges = self.split(size)
+        with open(target_path, 'wb') as f:
+            preallocate(f, size)
+
+        self._m_size = size
+        self._m_callback = callback
+
+        progress = [0] * len(ranges)
+        results = [False] * len(ranges)
+        threads = []
+        for i, (offset, length) in enumerate(ranges):
+            thread = threading.Thread(target=self._fetch,
+                                      args=(directory, filename, target_path,
+                                            offset, length, passive,
+                                            progress, results, i))
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+
+        if self.client is not None:
+            self.client.stop = False
+
+        if not all(results):
+            # the preallocated file is full size with holes where ranges
+            # failed, nothing to resume from
+            try:
+                os.remove(target_path)
+            except OSError:
+                pass
+            return False
+        return True
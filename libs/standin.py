@@ -0,0 +1,422 @@
+# encoding: utf-8
+import time
+import zlib
+import socket
+import posixpath
+import threading
+import SocketServer
+
+
+# file contents are generated, byte p of every file is chr(p % 251), so
+# transfers can be checked without keeping anything on disk
+_PATTERN = ''.join(chr(i % 251) for i in xrange(251))
+_BLOCK = _PATTERN * 1044
+_LIST_BATCH = 1000
+
+
+class VirtualFS(object):
+
+    MODIFY = '20150101000000'
+
+    def __init__(self):
+        # directory path -> {name: size, or None for a subdirectory}
+        self.dirs = {'/': {}}
+        # directory path -> modify fact, set when names come or go
+        self.modified = {}
+        self._m_lock = threading.Lock()
+
+
+    def _touch(self, directory):
+        self.modified[directory] = time.strftime('%Y%m%d%H%M%S',
+                                                 time.gmtime())
+
+
+    def add_dir(self, path):
+        path = posixpath.normpath(path)
+        with self._m_lock:
+            name = None
+            while True:
+                created = path not in self.dirs
+                entries = self.dirs.setdefault(path, {})
+                if name is not None and name not in entries:
+                    entries[name] = None
+                    self._touch(path)
+                if not created:
+                    break
+                path, name = posixpath.split(path)
+
+
+    def add_file(self, path, size):
+        path = posixpath.normpath(path)
+        directory, name = posixpath.split(path)
+        self.add_dir(directory)
+        with self._m_lock:
+            if name not in self.dirs[directory]:
+                self._touch(directory)
+            self.dirs[directory][name] = size
+
+
+    def populate(self, directory, count, size=0, prefix='file'):
+        self.add_dir(directory)
+        directory = posixpath.normpath(directory)
+        with self._m_lock:
+            entries = self.dirs[directory]
+            for i in xrange(count):
+                entries['%s%07d' % (prefix, i)] = size
+            self._touch(directory)
+
+
+    def remove(self, path):
+        path = posixpath.normpath(path)
+        directory, name = posixpath.split(path)
+        with self._m_lock:
+            if self.dirs.get(directory, {}).pop(name, False) is not False:
+                self._touch(directory)
+            prefix = path + '/'
+            for subdirectory in list(self.dirs):
+                if subdirectory == path or subdirectory.startswith(prefix):
+                    del self.dirs[subdirectory]
+                    self.modified.pop(subdirectory, None)
+
+
+    def modify(self, path):
+        return self.modified.get(posixpath.normpath(path), self.MODIFY)
+
+
+    def size(self, path):
+        directory, name = posixpath.split(posixpath.normpath(path))
+        with self._m_lock:
+            return self.dirs.get(directory, {}).get(name)
+
+
+    def is_dir(self, path):
+        return posixpath.normpath(path) in self.dirs
+
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+
+    def setup(self):
+        # replies are small writes answered by the next command; without
+        # this, Nagle and delayed acks add tens of milliseconds to each
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        SocketServer.StreamRequestHandler.setup(self)
+        self.fs = self.server.fs
+        self.cwd = '/'
+        self.rest = 0
+        self.mode = 'S'
+        self.passive = None
+        self.active = None
+
+
+    def reply(self, text):
+        self.wfile.write(text + '\r\n')
+        self.wfile.flush()
+
+
+    def path(self, arg):
+        return posixpath.normpath(posixpath.join(self.cwd, arg or '.'))
+
+
+    def handle(self):
+        self.reply('220 FTPient stand-in ready')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            cmd, _, arg = line.rstrip('\r\n').partition(' ')
+            method = getattr(self, 'ftp_' + cmd.upper(), None)
+            if method is None:
+                self.reply('502 Command not implemented')
+            elif method(arg) is False:
+                break
+
+        for sock in (self.passive, self.active):
+            if sock is not None:
+                sock.close()
+
+
+    def ftp_USER(self, arg):
+        self.reply('331 Password required')
+
+
+    def ftp_PASS(self, arg):
+        self.reply('230 Logged in')
+
+
+    def ftp_SYST(self, arg):
+        self.reply('215 UNIX Type: L8')
+
+
+    def ftp_FEAT(self, arg):
+        self.reply('211-Features:\r\n MLSD\r\n MLST type*;size*;modify*;\r\n'
+                   ' SIZE\r\n REST STREAM\r\n MFMT\r\n MODE Z\r\n211 End')
+
+
+    def ftp_NOOP(self, arg):
+        self.reply('200 NOOP ok')
+
+
+    def ftp_QUIT(self, arg):
+        self.reply('221 Goodbye')
+        return False
+
+
+    def ftp_TYPE(self, arg):
+        self.reply('200 Type set to %s' % arg)
+
+
+    def ftp_MODE(self, arg):
+        if arg.upper() not in ('S', 'Z'):
+            self.reply('504 Unsupported mode')
+            return
+        self.mode = arg.upper()
+        self.reply('200 Mode set to %s' % self.mode)
+
+
+    def ftp_PWD(self, arg):
+        self.reply('257 "%s" is the current directory'
+                   % self.cwd.replace('"', '""'))
+
+
+    def ftp_CWD(self, arg):
+        path = self.path(arg)
+        if not self.fs.is_dir(path):
+            self.reply('550 No such directory')
+            return
+        self.cwd = path
+        self.reply('250 Directory changed to %s' % path)
+
+
+    def ftp_CDUP(self, arg):
+        self.ftp_CWD('..')
+
+
+    def ftp_MKD(self, arg):
+        path = self.path(arg)
+        self.fs.add_dir(path)
+        self.reply('257 "%s" created' % path)
+
+
+    def ftp_MFMT(self, arg):
+        modify, _, name = arg.partition(' ')
+        if self.fs.size(self.path(name)) is None:
+            self.reply('550 No such file')
+            return
+        self.reply('213 Modify=%s; %s' % (modify, name))
+
+
+    def ftp_SIZE(self, arg):
+        size = self.fs.size(self.path(arg))
+        if size is None:
+            self.reply('550 No such file')
+            return
+        self.reply('213 %d' % size)
+
+
+    def ftp_MDTM(self, arg):
+        if self.fs.size(self.path(arg)) is None:
+            self.reply('550 No such file')
+            return
+        self.reply('213 %s' % self.fs.MODIFY)
+
+
+    def ftp_REST(self, arg):
+        self.rest = int(arg)
+        self.reply('350 Restarting at %d' % self.rest)
+
+
+    def ftp_PASV(self, arg):
+        if self.passive is not None:
+            self.passive.close()
+        self.passive = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.passive.bind((self.connection.getsockname()[0], 0))
+        self.passive.listen(1)
+
+        ip, port = self.passive.getsockname()
+        self.reply('227 Entering Passive Mode (%s,%d,%d)'
+                   % (ip.replace('.', ','), port // 256, port % 256))
+
+
+    def ftp_PORT(self, arg):
+        t = arg.split(',')
+        self.active = ('.'.join(t[:4]), int(t[4]) * 256 + int(t[5]))
+        self.reply('200 PORT command successful')
+
+
+    def _open_data(self):
+        if self.passive is not None:
+            listener, self.passive = self.passive, None
+            conn, _ = listener.accept()
+            listener.close()
+        elif self.active is not None:
+            address, self.active = self.active, None
+            conn = socket.create_connection(address)
+        else:
+            self.reply('425 Use PORT or PASV first')
+            return None
+
+        conn.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1024 * 1024)
+        return conn
+
+
+    def _writer(self, conn):
+        if self.mode != 'Z':
+            return conn.sendall, lambda: None
+
+        deflate = zlib.compressobj(1)
+
+        def write(data):
+            out = deflate.compress(data)
+            if out:
+                conn.sendall(out)
+
+        return write, lambda: conn.sendall(deflate.flush())
+
+
+    def ftp_MLSD(self, arg):
+        path = self.path(arg)
+        if not self.fs.is_dir(path):
+            self.reply('550 No such directory')
+            return
+
+        self.reply('150 Opening data connection')
+        conn = self._open_data()
+        if conn is None:
+            return
+
+        write, finish = self._writer(conn)
+        modify = self.fs.MODIFY
+        lines = ['type=cdir;modify=%s; .' % self.fs.modify(path)]
+        for name, size in self.fs.dirs[path].items():
+            if size is None:
+                lines.append('type=dir;modify=%s; %s'
+                             % (self.fs.modify(posixpath.join(path, name)),
+                                name))
+            else:
+                lines.append('type=file;size=%d;modify=%s; %s'
+                             % (size, modify, name))
+            if len(lines) >= _LIST_BATCH:
+                write('\r\n'.join(lines) + '\r\n')
+                lines = []
+        if lines:
+            write('\r\n'.join(lines) + '\r\n')
+        finish()
+
+        conn.close()
+        self.reply('226 Transfer complete')
+
+
+    def ftp_MLST(self, arg):
+        path = self.path(arg)
+        if self.fs.is_dir(path):
+            facts = 'type=dir;modify=%s;' % self.fs.modify(path)
+        else:
+            size = self.fs.size(path)
+            if size is None:
+                self.reply('550 No such file or directory')
+                return
+            facts = 'type=file;size=%d;modify=%s;' % (size, self.fs.MODIFY)
+        self.reply('250-Listing %s\r\n %s %s\r\n250 End'
+                   % (path, facts, path))
+
+
+    def ftp_RETR(self, arg):
+        size = self.fs.size(self.path(arg))
+        offset, self.rest = self.rest, 0
+        if size is None:
+            self.reply('550 No such file')
+            return
+
+        self.reply('150 Opening data connection')
+        conn = self._open_data()
+        if conn is None:
+            return
+
+        write, finish = self._writer(conn)
+        position, block = offset, len(_BLOCK)
+        try:
+            while position < size:
+                start = position % block
+                n = min(block - start, size - position)
+                write(buffer(_BLOCK, start, n))
+                position += n
+            finish()
+        except socket.error:
+            conn.close()
+            self.reply('426 Connection closed, transfer aborted')
+            return
+
+        conn.close()
+        self.reply('226 Transfer complete')
+
+
+    def _store(self, arg, append):
+        path = self.path(arg)
+        offset, self.rest = self.rest, 0
+        if append:
+            offset = self.fs.size(path) or 0
+
+        self.reply('150 Opening data connection')
+        conn = self._open_data()
+        if conn is None:
+            return
+
+        inflate = zlib.decompressobj() if self.mode == 'Z' else None
+        buf = bytearray(256 * 1024)
+        received = 0
+        while True:
+            n = conn.recv_into(buf)
+            if not n:
+                break
+            if inflate is None:
+                received += n
+            else:
+                received += len(inflate.decompress(buffer(buf, 0, n)))
+            # the size grows as data comes in, as on a disk
+            self.fs.add_file(path, offset + received)
+        if inflate is not None:
+            received += len(inflate.flush())
+        conn.close()
+
+        self.fs.add_file(path, offset + received)
+        self.reply('226 Transfer complete')
+
+
+    def ftp_STOR(self, arg):
+        self._store(arg, False)
+
+
+    def ftp_APPE(self, arg):
+        self._store(arg, True)
+
+
+
+class StandInServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, fs=None, address=('127.0.0.1', 0)):
+        SocketServer.TCPServer.__init__(self, address, _Handler)
+        self.fs = fs if fs is not None else VirtualFS()
+        self._m_thread = None
+
+
+    @property
+    def address(self):
+        return self.server_address
+
+
+    def start(self):
+        self._m_thread = threading.Thread(target=self.serve_forever)
+        self._m_thread.daemon = True
+        self._m_thread.start()
+        return self
+
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._m_thread is not None:
+            self._m_thread.join()
@@ -0,0 +1,87 @@
+# encoding: utf-8
+import threading
+import time
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate=0, burst=None):
+        self._m_lock = threading.Lock()
+        self.set_rate(rate, burst)
+
+
+    def set_rate(self, rate, burst=None):
+        # a rate of 0 means unlimited
+        with self._m_lock:
+            self.rate = rate
+            self.burst = burst or rate
+            self._m_tokens = self.burst
+            self._m_last = time.time()
+
+
+    def reserve(self, n):
+        # tokens may go negative; the caller waits off the debt before the
+        # next chunk instead of being refused
+        if not self.rate:
+            return 0.0
+
+        with self._m_lock:
+            now = time.time()
+            self._m_tokens = min(self.burst, self._m_tokens +
+                                             (now - self._m_last) * self.rate)
+            self._m_last = now
+            self._m_tokens -= n
+            if self._m_tokens >= 0:
+                return 0.0
+            return -self._m_tokens / float(self.rate)
+
+
+
+class Throttle(object):
+
+    # debts shorter than this are carried over to the next chunk
+    MIN_SLEEP = 0.01
+    # chunks are sized to about this much time at the slowest rate
+    CHUNK_TIME = 0.05
+    MIN_CHUNK = 4 * 1024
+
+    def __init__(self, *buckets):
+        self.buckets = buckets
+
+
+    def chunk(self, size):
+        rates = [b.rate for b in self.buckets if b.rate]
+        if not rates:
+            return size
+        return max(self.MIN_CHUNK, min(size, int(min(rates) * self.CHUNK_TIME)))
+
+
+    def consume(self, n):
+        delay = 0.0
+        for bucket in self.buckets:
+            delay = max(delay, bucket.reserve(n))
+        if delay >= self.MIN_SLEEP:
+            time.sleep(delay)
+
+
+
+process = TokenBucket()
+
+_servers = {}
+_servers_lock = threading.Lock()
+
+
+def server_bucket(server_ip):
+    with _servers_lock:
+        bucket = _servers.get(server_ip)
+        if bucket is None:
+            bucket = _servers[server_ip] = TokenBucket()
+        return bucket
+
+
+def set_process_limit(rate, burst=None):
+    process.set_rate(rate, burst)
+
+
+def set_server_limit(server_ip, rate, burst=None):
+    server_bucket(server_ip).set_rate(rate, burst)
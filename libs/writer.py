@@ -0,0 +1,137 @@
+# encoding: utf-8
+import os
+import ctypes
+import ctypes.util
+import threading
+from Queue import Queue
+
+
+# linux fallocate() mode that reserves blocks past the end of the file
+FALLOC_FL_KEEP_SIZE = 1
+
+
+def _libc_function(names, argtypes):
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'))
+    except OSError:
+        return None
+    for name in names:
+        function = getattr(libc, name, None)
+        if function is not None:
+            function.argtypes = argtypes
+            function.restype = ctypes.c_int
+            return function
+    return None
+
+# os.posix_fallocate only came with python 3
+_posix_fallocate = _libc_function(('posix_fallocate64', 'posix_fallocate'),
+                                  [ctypes.c_int, ctypes.c_int64,
+                                   ctypes.c_int64])
+_fallocate = _libc_function(('fallocate64', 'fallocate'),
+                            [ctypes.c_int, ctypes.c_int, ctypes.c_int64,
+                             ctypes.c_int64])
+
+
+def preallocate(f, size, keep_size=False):
+    # reserves size bytes for f; a sparse file where the file system or
+    # the platform cannot do that. with keep_size the length of f stays
+    # what was written, so a partial file still tells how much it holds;
+    # that only works with linux fallocate(), elsewhere nothing is reserved.
+    if keep_size:
+        return _fallocate is not None and \
+               _fallocate(f.fileno(), FALLOC_FL_KEEP_SIZE, 0, size) == 0
+    if _posix_fallocate is not None and \
+       _posix_fallocate(f.fileno(), 0, size) == 0:
+        return True
+    f.truncate(size)
+    return False
+
+
+class DiskWriter(threading.Thread):
+
+    def __init__(self, path, size=None, offset=None, hasher=None,
+                       buffers=8, buffer_size=256 * 1024, copy_path=None):
+        super(DiskWriter, self).__init__()
+        self.daemon = True
+
+        if offset is None:
+            self._m_file = open(path, 'wb')
+            self._m_truncate = True
+            if size:
+                # an interrupted download is resumed from its length
+                preallocate(self._m_file, size, keep_size=True)
+        else:
+            self._m_file = open(path, 'r+b')
+            self._m_file.seek(offset, os.SEEK_SET)
+            self._m_truncate = False
+
+        self.buffer_size = buffer_size
+        self._m_free = Queue()
+        for _ in range(buffers):
+            self._m_free.put(bytearray(buffer_size))
+        self._m_filled = Queue()
+
+        self.hasher = hasher
+        self.written = 0
+        self.error = None
+
+        # a second file getting the same bytes, such as a content cache
+        # entry; trouble with it never fails the transfer
+        self._m_copy = None
+        self.copy_error = None
+        if copy_path is not None:
+            try:
+                self._m_copy = open(copy_path, 'wb')
+            except IOError as e:
+                self.copy_error = e
+
+
+    def acquire(self):
+        return self._m_free.get()
+
+
+    def submit(self, buf, length):
+        self._m_filled.put((buf, length))
+
+
+    def release(self, buf):
+        self._m_free.put(buf)
+
+
+    def run(self):
+        while True:
+            buf, length = self._m_filled.get()
+            if buf is None:
+                break
+
+            if self.error is None:
+                try:
+                    self._m_file.write(memoryview(buf)[:length])
+                    self.written += length
+                    if self.hasher is not None:
+                        self.hasher.update(buffer(buf, 0, length))
+                except (IOError, OSError) as e:
+                    self.error = e
+            if self._m_copy is not None and self.copy_error is None:
+                try:
+                    self._m_copy.write(memoryview(buf)[:length])
+                except (IOError, OSError) as e:
+                    self.copy_error = e
+            self._m_free.put(buf)
+
+
+    def close(self):
+        self._m_filled.put((None, 0))
+        self.join()
+
+        if self._m_truncate and self.error is None:
+            # drop the preallocated tail when the transfer ended early
+            self._m_file.truncate(self.written)
+        self._m_file.close()
+        if self._m_copy is not None:
+            try:
+                self._m_copy.close()
+            except (IOError, OSError) as e:
+                self.copy_error = e
+
+        return self.written
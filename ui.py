@@ -1,28 +1,54 @@
 # encoding: utf-8
 import os
-import threading
+import logging
 import sys
 
 from PySide.QtGui import *
 from PySide.QtCore import *
 
 from libs.ftp import FTPClient
-from libs.misc import LoggerHandler
+from libs.cache import ListingCache, ContentCache
+from libs.pool import get_pool
+from libs.progress import ProgressReporter
+from libs.mirror import Mirror
+from libs.scheduler import Scheduler
+from libs.prefetch import Prefetcher
+from libs.listing import Listing
+from libs.index import RemoteIndex, Crawler, index_path
+from libs import logs
 from libs.components import LoginDialog, FileModel, WaitDialog
 
 
 class FTPClientPanel(QDialog, object):
 
-    signal_list_end = Signal(list)
+    LOG_SCROLLBACK = 5000
+    CONTENT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.ftpient',
+                                     'content')
+    CONTENT_CACHE_SIZE = 2 * 1024 ** 3
+
+    signal_list_end = Signal(object)
     signal_download_end = Signal(bool)
     signal_download_start = Signal()
     signal_upload_end = Signal(bool)
     signal_upload_start = Signal()
+    signal_crawl_end = Signal(object)
 
     def __init__(self, server_ip):
         super(FTPClientPanel, self).__init__()
 
+        self.listing_cache = ListingCache()
         self.client = FTPClient(server_ip)
+        self.client.listing_cache = self.listing_cache
+        # unchanged files are linked from here instead of downloaded again
+        self.content_cache = ContentCache(self.CONTENT_CACHE_DIR,
+                                          self.CONTENT_CACHE_SIZE)
+        self.client.content_cache = self.content_cache
+        self.pool = None
+        self.scheduler = None
+        self.prefetcher = None
+        self.index = None
+        # transfers that failed or were stopped, picked up again with REST
+        self.interrupted = set()
 
         self.entries = []
 
@@ -35,13 +61,28 @@ class FTPClientPanel(QDialog, object):
         self.btn_download = QPushButton(u'下载')
         self.btn_show_logger = QPushButton(u'日志')
         self.btn_login = QPushButton(u'登录')
+        self.btn_mirror = QPushButton(u'同步此目录')
+        self.btn_crawl = QPushButton(u'更新索引')
 
         self.view_ftp = QTreeView(self)
         self.view_ftp.setItemsExpandable(False)
         self.view_ftp.setExpandsOnDoubleClick(False)
         self.view_ftp.setRootIsDecorated(False)
+        self.view_ftp.setUniformRowHeights(True)
+        self.view_ftp.setMouseTracking(True)
         self.model = FileModel(self.entries, self)
         self.view_ftp.setModel(self.model)
+        self.view_ftp.setSortingEnabled(True)
+        self.view_ftp.sortByColumn(0, Qt.AscendingOrder)
+
+        self.edit_filter = QLineEdit(self)
+        self.edit_filter.setPlaceholderText(u'筛选')
+        self.edit_filter.textChanged.connect(self.model.set_filter)
+
+        # answered from the index, the server is not asked
+        self.edit_search = QLineEdit(self)
+        self.edit_search.setPlaceholderText(u'搜索全部文件，可用 * ?')
+        self.edit_search.returnPressed.connect(self.search)
 
         self.dialog_logger = QDialog(self)
         self.dialog_login = LoginDialog(self)
@@ -57,8 +98,12 @@ class FTPClientPanel(QDialog, object):
         self.signal_download_end.connect(self.download_end)
         self.signal_upload_start.connect(self.upload_start)
         self.signal_upload_end.connect(self.upload_end)
+        self.signal_crawl_end.connect(self.crawl_end)
 
         self.view_ftp.doubleClicked.connect(self.double_click_item)
+        self.view_ftp.entered.connect(self.hint_item)
+        self.view_ftp.selectionModel().currentChanged.connect(
+            lambda current, _: self.hint_item(current))
 
         self.current_ftp_path = '/'
 
@@ -72,6 +117,15 @@ class FTPClientPanel(QDialog, object):
             self.download()
 
 
+    def hint_item(self, idx):
+        if self.prefetcher is None:
+            return
+        entry = self.model.data(idx, role=Qt.UserRole)
+        if entry is not None and entry.is_dir():
+            self.prefetcher.hint(os.path.normpath(
+                os.path.join(self.current_ftp_path, entry.name)))
+
+
     def download(self):
         idx = self.view_ftp.selectedIndexes()
         if not idx:
@@ -80,9 +134,10 @@ class FTPClientPanel(QDialog, object):
         idx = idx[0]
         entry = self.model.data(idx, role=Qt.UserRole)
 
+        # search results are named by their full path
         save_path, _ = QFileDialog.getSaveFileName(self,
                                                    u'下载至',
-                                                   os.path.join('.', entry.name),
+                                                   os.path.join('.', os.path.basename(entry.name)),
                                                    u'所有文件 (*.*)')
         if not save_path:
             return
@@ -101,16 +156,58 @@ class FTPClientPanel(QDialog, object):
             return
 
         _, filename = os.path.split(path)
-        self.asynchronized_upload(filename, path)
+        self.asynchronized_upload(os.path.join(self.current_ftp_path,
+                                               filename),
+                                  path)
+
+
+    def mirror(self):
+        local_dir = QFileDialog.getExistingDirectory(self, u'同步至', '.')
+        if not local_dir:
+            return
+
+        self.asynchronized_mirror(self.current_ftp_path, local_dir)
+
+
+    def search(self):
+        # nothing to list or search before the first login
+        if self.scheduler is None:
+            return
+        text = self.edit_search.text().strip()
+        if not text:
+            self.asynchronized_list(self.current_ftp_path)
+            return
+        if self.index is None:
+            return
+
+        if any(c in text for c in u'*?['):
+            found = self.index.search(pattern=text)
+        else:
+            found = self.index.search(substring=text)
+
+        entries = Listing()
+        entries.append(u'..', False)
+        for entry in found:
+            entries.append(entry.path, entry.is_file, entry.size,
+                           entry.modify)
+        self.show_list(entries)
+
+
+    def crawl(self):
+        self.asynchronized_crawl('/')
 
 
     def setup_layout(self):
         grid = QGridLayout()
-        grid.addWidget(self.view_ftp, 0, 0, 1, 2)
-        grid.addWidget(self.btn_upload, 1, 0, 1, 1)
-        grid.addWidget(self.btn_login, 1, 1, 1, 1)
-        grid.addWidget(self.btn_download, 2, 0, 1, 1)
-        grid.addWidget(self.btn_show_logger, 2, 1, 1, 1)
+        grid.addWidget(self.edit_filter, 0, 0, 1, 2)
+        grid.addWidget(self.view_ftp, 1, 0, 1, 2)
+        grid.addWidget(self.btn_upload, 2, 0, 1, 1)
+        grid.addWidget(self.btn_login, 2, 1, 1, 1)
+        grid.addWidget(self.btn_download, 3, 0, 1, 1)
+        grid.addWidget(self.btn_show_logger, 3, 1, 1, 1)
+        grid.addWidget(self.btn_mirror, 4, 0, 1, 1)
+        grid.addWidget(self.btn_crawl, 4, 1, 1, 1)
+        grid.addWidget(self.edit_search, 5, 0, 1, 2)
 
         self.setLayout(grid)
 
@@ -118,15 +215,21 @@ class FTPClientPanel(QDialog, object):
         self.btn_login.clicked.connect(self.show_login)
         self.btn_download.clicked.connect(self.download)
         self.btn_upload.clicked.connect(self.upload)
+        self.btn_mirror.clicked.connect(self.mirror)
+        self.btn_crawl.clicked.connect(self.crawl)
 
 
     def setup_logger(self):
-        handler = LoggerHandler(self.widget_logger)
-        self.client._m_logger.addHandler(handler)
-        self.connect(self.widget_logger,
-                     SIGNAL('new_log(QString)'),
-                     self.widget_logger,
-                     SLOT('append(QString)'))
+        # the pipeline thread fills the buffer, the timer moves whatever
+        # piled up into the widget in one insert
+        self.log_lines = logs.LineBuffer(self.LOG_SCROLLBACK)
+        logs.pipeline.add_sink(self.log_lines.extend)
+        self.widget_logger.document().setMaximumBlockCount(
+            self.LOG_SCROLLBACK)
+
+        self.timer_logger = QTimer(self)
+        self.timer_logger.timeout.connect(self.flush_log)
+        self.timer_logger.start(250)
 
         self.dialog_logger.setWindowTitle(u'日志')
         self.dialog_logger.resize(400, 200)
@@ -135,9 +238,36 @@ class FTPClientPanel(QDialog, object):
         self.dialog_logger.setLayout(layout)
 
 
+    def flush_log(self):
+        lines = self.log_lines.drain()
+        if not lines:
+            return
+
+        self.widget_logger.moveCursor(QTextCursor.End)
+        if not self.widget_logger.document().isEmpty():
+            self.widget_logger.insertPlainText('\n')
+        self.widget_logger.insertPlainText('\n'.join(lines))
+        self.widget_logger.ensureCursorVisible()
+
+
     def show_login(self):
         logged = self.dialog_login.exec_()
         if logged:
+            self.listing_cache.invalidate()
+            pool = get_pool(*self.dialog_login.credentials,
+                            listing_cache=self.listing_cache,
+                            content_cache=self.content_cache)
+            if pool is not self.pool:
+                if self.scheduler is not None:
+                    self.scheduler.shutdown()
+                self.pool = pool
+                self.scheduler = Scheduler(pool)
+                self.prefetcher = Prefetcher(self.scheduler,
+                                             self.listing_cache)
+                if self.index is not None:
+                    self.index.close()
+                server_ip, username, _ = self.dialog_login.credentials
+                self.index = RemoteIndex(index_path(server_ip, username))
             self.unlock()
             self.current_ftp_path = '/'
             self.asynchronized_list(self.current_ftp_path)
@@ -148,11 +278,17 @@ class FTPClientPanel(QDialog, object):
     def lock(self):
         self.btn_upload.setEnabled(False)
         self.btn_download.setEnabled(False)
+        self.btn_mirror.setEnabled(False)
+        self.btn_crawl.setEnabled(False)
+        self.edit_search.setEnabled(False)
 
 
     def unlock(self):
         self.btn_upload.setEnabled(True)
         self.btn_download.setEnabled(True)
+        self.btn_mirror.setEnabled(True)
+        self.btn_crawl.setEnabled(True)
+        self.edit_search.setEnabled(True)
 
 
     def show_logger(self):
@@ -163,40 +299,114 @@ class FTPClientPanel(QDialog, object):
 
 
     def asynchronized_list(self, path):
-        def _():
-            success, ret = self.client.list(path)
-            if not success:
-                return
-            self.signal_list_end.emit(ret)
-
-        threading.Thread(target=_).start()
-
-    def callback(self, total, now):
-        self.dialog_wait.signal_update_progress.emit(
-            self.model.to_human_readable(now),
-            self.model.to_human_readable(total)
-        )
-        self.dialog_wait.signal_update_bar.emit(int(float(now) / total * 100))
+        # prefetched listings show without a round trip
+        entries = self.listing_cache.get(path)
+        if entries is not None:
+            self.show_list(entries)
+            self.prefetcher.visited(path, entries)
+            return None
+
+        def _(client):
+            success, ret = client.list(path)
+            if success:
+                self.signal_list_end.emit(ret)
+                self.prefetcher.visited(path, ret)
+            return success
+
+        return self.scheduler.submit(_, priority=Scheduler.LISTING,
+                                     name=u'LIST %s' % path)
+
+    def progress_reporter(self):
+        return ProgressReporter(self.dialog_wait.signal_progress.emit)
+
+
+    def mark_interrupted(self, path, target_path, success, resumable=True):
+        # only a short copy is worth resuming; a failed checksum removes it
+        if success or not resumable:
+            self.interrupted.discard((path, target_path))
+        else:
+            self.interrupted.add((path, target_path))
 
 
     def asynchronized_download(self, path, target_path):
-        def _():
+        # retries pick up where the failed attempt stopped
+        def _(client):
             self.signal_download_start.emit()
             self.dialog_wait.signal_change_label.emit(u'正在传输%s，请稍候' % path)
-            success = self.client.download(path, target_path, callback=self.callback)
-            self.signal_download_end.emit(success)
+            progress = self.progress_reporter()
+            resume = (path, target_path) in self.interrupted
+            success = client.download(path, target_path, callback=progress,
+                                      resume=resume, verify=True)
+            self.mark_interrupted(path, target_path, success,
+                                  os.path.isfile(target_path))
+            progress.finish()
+            return success
 
-        threading.Thread(target=_).start()
+        return self.scheduler.submit(_, priority=Scheduler.TRANSFER,
+                                     callback=self.signal_download_end.emit,
+                                     name=u'RETR %s' % path)
 
 
     def asynchronized_upload(self, path, target_path):
-        def _():
+        def _(client):
             self.signal_upload_start.emit()
             self.dialog_wait.signal_change_label.emit(u'正在传输%s，请稍候' % path)
-            success = self.client.upload(path, target_path, callback=self.callback)
-            self.signal_upload_end.emit(success)
-
-        threading.Thread(target=_).start()
+            progress = self.progress_reporter()
+            resume = (path, target_path) in self.interrupted
+            success = client.upload(path, target_path, callback=progress,
+                                    resume=resume, verify=True)
+            self.mark_interrupted(path, target_path, success)
+            progress.finish()
+            return success
+
+        return self.scheduler.submit(_, priority=Scheduler.TRANSFER,
+                                     callback=self.signal_upload_end.emit,
+                                     name=u'STOR %s' % path)
+
+
+    def asynchronized_mirror(self, path, target_path):
+        # the mirror takes pooled sessions of its own; the stop button
+        # cancels its token and it stops between files
+        def _(token):
+            self.signal_download_start.emit()
+            self.dialog_wait.signal_change_label.emit(u'正在同步%s，请稍候' % path)
+            mirror = Mirror(self.pool, workers=self.pool.size,
+                            callback=self.dialog_wait.signal_progress.emit,
+                            token=token)
+            ret = mirror.download(path, target_path)
+            return not ret['failed']
+
+        return self.scheduler.submit(_, priority=Scheduler.BULK,
+                                     callback=self.signal_download_end.emit,
+                                     retries=0, name=u'MIRROR %s' % path,
+                                     session=False)
+
+
+    def asynchronized_crawl(self, path):
+        # directories unchanged since the last crawl are not listed again
+        def _(token):
+            self.dialog_wait.signal_change_label.emit(u'正在建立索引%s' % path)
+            crawler = Crawler(self.pool, self.index, workers=self.pool.size,
+                              token=token)
+            try:
+                stats = crawler.crawl(path)
+            except Exception:
+                crawler._m_logger.error('index: crawl of %s failed', path,
+                                        exc_info=True)
+                stats = {'failed': [path]}
+            self.signal_crawl_end.emit(stats)
+            return not stats['failed']
+
+        return self.scheduler.submit(_, priority=Scheduler.BULK, retries=0,
+                                     name=u'INDEX %s' % path, session=False)
+
+
+    def crawl_end(self, stats):
+        if stats['failed']:
+            self.dialog_wait.signal_change_label.emit(u'索引未完成')
+        else:
+            self.dialog_wait.signal_change_label.emit(
+                u'索引完成，共%d个文件' % self.index.stats()['files'])
 
 
     def download_start(self):
@@ -231,18 +441,24 @@ class FTPClientPanel(QDialog, object):
 
 
     def show_list(self, entries):
+        self.edit_filter.clear()
         self.model.reset_entries(entries)
 
 
 
 
-if __name__ == '__main__':
+def main():
+    logs.setup(logging.INFO)
     app = QApplication(sys.argv)
 
     panel = FTPClientPanel('127.0.0.1')
     panel.show()
 
-    app.exec_()
+    return app.exec_()
+
+
+if __name__ == '__main__':
+    main()
 
 
 